@@ -2,6 +2,97 @@ import time
 import math
 import numpy as np
 import os,shutil,subprocess,sys
+import json
+import platform
+from contextlib import contextmanager
+
+##### --------------------------------------------------------------------------
+# PROFILING
+##### --------------------------------------------------------------------------
+
+class RunProfiler:
+    """
+    Opt-in stage profiler for the analysis routines.
+    Every `with profiler.stage('name', frame=i) as rec:` block records its wall time,
+    the peak traced memory (tracemalloc) and the bytes read (to be set by the caller 
+    in rec['bytes_read']). Stages can be nested: the peak memory of an inner stage 
+    is also accounted in the outer one.
+    With enabled=False the stages are still usable but nothing is recorded.
+    """
+    def __init__(self, name='analysis', enabled=True):
+        self.name = name
+        self.enabled = enabled
+        self.records = []
+        self._stack = []
+        self._t0 = time.perf_counter()
+        self._started_tracing = False
+
+    @contextmanager
+    def stage(self, name, frame=None):
+        rec = {'stage': name, 'frame': frame, 'wall_time': 0.0, 'bytes_read': 0, 'peak_memory': 0}
+        if not self.enabled:
+            yield rec
+            return
+
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        # fold the peak reached so far by the parent stage before resetting it
+        if self._stack:
+            self._stack[-1]['peak_memory'] = max(self._stack[-1]['peak_memory'], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        mem0 = tracemalloc.get_traced_memory()[0]
+        self._stack.append(rec)
+        t0 = time.perf_counter()
+        try:
+            yield rec
+        finally:
+            rec['wall_time'] = time.perf_counter() - t0
+            rec['peak_memory'] = max(rec['peak_memory'], tracemalloc.get_traced_memory()[1]) - mem0
+            self._stack.pop()
+            if self._stack:
+                parent = self._stack[-1]
+                parent['peak_memory'] = max(parent['peak_memory'], rec['peak_memory'] + mem0)
+                parent['bytes_read'] += rec['bytes_read']
+            self.records.append(rec)
+
+    def summary(self):
+        """ Totals per stage name (count, wall time, bytes read, max peak memory) """
+        summary = {}
+        for rec in self.records:
+            s = summary.setdefault(rec['stage'], {'count': 0, 'wall_time': 0.0, 'bytes_read': 0, 'peak_memory': 0})
+            s['count'] += 1
+            s['wall_time'] += rec['wall_time']
+            s['bytes_read'] += rec['bytes_read']
+            s['peak_memory'] = max(s['peak_memory'], rec['peak_memory'])
+        return summary
+
+    def report(self):
+        return {
+            'name': self.name,
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'host': platform.node(),
+            'total_wall_time': time.perf_counter() - self._t0,
+            'summary': self.summary(),
+            'stages': [r for r in self.records if r['frame'] is None],
+            'frames': [r for r in self.records if r['frame'] is not None],
+        }
+
+    def write_report(self, filename):
+        if not self.enabled:
+            return None
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        if self._started_tracing:
+            import tracemalloc
+            tracemalloc.stop()
+            self._started_tracing = False
+        print('Profiling report written in {}'.format(filename))
+        return filename
+
 
 ##### --------------------------------------------------------------------------
 # ANALYSIS
@@ -25,11 +116,60 @@ def read_output_files(rundir, what='undercoordinated'):
             \'undercoordinated\', \'defects\', \'wrong\' or \'vacancies\'')
         sys.exit()
 
+    # Sort by frame (I00000000, I00000001, ...): glob order is arbitrary on most file systems
+    files = sorted(files)
     print('There are {} \'{}\' files available in {}'.format(len(files), what, rundir))
 
     return files
 
 
+def frame_index(filename):
+    """ Frame number from the name of a MulSKIPS output file (e.g. I00000012_w.xyz -> 12) """
+    return int(os.path.basename(filename)[1:9])
+
+
+def map_frames(func, jobs, nprocs=1):
+    """
+    Frame pipeline: apply func to every job (typically one xyz file per frame) and 
+    return the results in the same order. With nprocs > 1 the frames are processed 
+    in nprocs worker processes, func must then be a module-level function.
+    """
+    jobs = list(jobs)
+    if nprocs is None or nprocs <= 1 or len(jobs) < 2:
+        return [func(job) for job in jobs]
+
+    import multiprocessing
+    nprocs = min(nprocs, len(jobs))
+    with multiprocessing.get_context('spawn').Pool(nprocs) as pool:
+        return pool.map(func, jobs, chunksize=max(1, len(jobs) // (4 * nprocs)))
+
+
+def get_kmc_time(filename):
+    """ KMC time written in the header of the undercoordinated (and defects) xyz files """
+    with open(filename) as f:
+        return float(f.readline().split()[3])
+
+
+def read_xyz_species_z(filename):
+    """
+    Stream a MulSKIPS xyz file and return (species, z, box sides).
+    Only species and z are kept, so memory scales with the atoms of one frame.
+    """
+    with open(filename) as f:
+        nat = int(f.readline().split()[0])
+        box = [float(v) for v in f.readline().split()[1:4]]
+        species, z = [], []
+        for line in f:
+            splitline = line.split()
+            if splitline:
+                species.append(splitline[0])
+                z.append(float(splitline[3]))
+    if len(z) != nat:
+        print('Error: nat and number of atoms in {} do not coincide'.format(filename))
+        sys.exit()
+    return np.array(species), np.array(z), box
+
+
 def get_box_sides(filename):
     with open (filename) as f:
         content = f.read().splitlines()
@@ -120,41 +260,58 @@ def visualize(rundirname, what='undercoordinated', iteration=0, slider=False):
         MolTo3DView(files[iteration]).show()
 
 # Main function of the notebook to get the surface height from a rough surface.
-def get_surface_height(filename,bin_size=2.0,surface_roughness=10.0):
+def get_surface_height(filename,bin_size=2.0,surface_roughness=10.0, profiler=None, frame=None):
     """
     bin_size [Angstroem] : size of the bins in the z direction to store all z-values in an histogram
     surface_roughness [Angstroem] : surface roughness in the z direction where to average the surface height
+    profiler : optional RunProfiler, the read/parse/histogram stages of this frame are recorded in it
     """
-    with open(filename) as f:
-        content = f.read().splitlines()
+    if profiler is None:
+        profiler = RunProfiler(enabled=False)
 
-    line=content[0]
-    splitline = line.split()
-    nat = int(splitline[0]) # Total number of atoms
-    #print('nat: {}'.format(nat))
-    line=content[1]
-    splitline = line.split()
-    bc=str(splitline[0])
-    xl=float(splitline[1])
-    yl=float(splitline[2])
-    zl=float(splitline[3])
-    #print(zl)
-    lines=content[2:]
-
-    all_z_values = []
-    all_at_species = []
-    for line in lines:
+    with profiler.stage('read', frame) as rec:
+        with open(filename) as f:
+            content = f.read()
+        rec['bytes_read'] = len(content)
+
+    with profiler.stage('parse', frame):
+        content = content.splitlines()
+        line=content[0]
         splitline = line.split()
-        at=str(splitline[0])
-        x=float(splitline[1])
-        y=float(splitline[2])
-        z=float(splitline[3])
-        all_z_values.append(z)
-        all_at_species.append(at)
-    if len(all_z_values) != nat:
-        print('Error: nat and len(all_z_values) do not coincide')
-        sys.exit()
+        nat = int(splitline[0]) # Total number of atoms
+        #print('nat: {}'.format(nat))
+        line=content[1]
+        splitline = line.split()
+        bc=str(splitline[0])
+        xl=float(splitline[1])
+        yl=float(splitline[2])
+        zl=float(splitline[3])
+        #print(zl)
+        lines=content[2:]
+
+        all_z_values = []
+        all_at_species = []
+        for line in lines:
+            splitline = line.split()
+            at=str(splitline[0])
+            x=float(splitline[1])
+            y=float(splitline[2])
+            z=float(splitline[3])
+            all_z_values.append(z)
+            all_at_species.append(at)
+        if len(all_z_values) != nat:
+            print('Error: nat and len(all_z_values) do not coincide')
+            sys.exit()
 
+    with profiler.stage('histogram', frame):
+        return get_surface_height_from_z(all_z_values, zl, bin_size, surface_roughness)
+
+
+def get_surface_height_from_z(all_z_values, zl, bin_size=2.0, surface_roughness=10.0):
+    """
+    Surface height from the list of z values of a frame (see get_surface_height)
+    zl [Angstroem] : size of the simulation box along z
+    """
     #print(max(all_z_values),min(all_z_values))
 
     # if all z values are equal or too close (< binsize), do not waste time on making hyst
@@ -205,21 +362,53 @@ def get_surface_height(filename,bin_size=2.0,surface_roughness=10.0):
 
         return z_ave
 
+def _surface_height_job(job):
+    filename, bin_size, surface_roughness = job
+    return get_surface_height(filename, bin_size, surface_roughness)
+
 def analyze_growth_rate(rundirname, bin_size=5.0,surface_roughness=20.0, method='finitediff',
-    plotting=True, figname=None, Nexclude=2, minframes=None, return_surf_height=False):
+    plotting=True, figname=None, Nexclude=2, minframes=None, return_surf_height=False, profile=False,
+    return_data=False, nprocs=1):
     """
     Growth rate extraction
     The following notebook allows to extract the growth rate from a Super lattice 
     Kinetic Monte Carlo simulation with the mulskips code. It is supposed that you
     run mulskips for a flat (001) surface, that is "F" letter as input geometry in 
     the file start.dat (see the tutorial to run the epitaxial growth of a surface with mulskips).
+
+    profile : if True, wall time, bytes read and peak memory of each stage (and of each 
+    frame) are written in <rundirname>/profile_growth_rate.json, also when there are too 
+    few frames. A path can be given instead, to write the report there. A RunProfiler 
+    instance can also be passed, in this case writing the report is left to the caller.
+    return_data : if True, the dict with all the curves (see draw_growth_rate) is returned 
+    instead of the average growth rate, so that plotting can be done later (e.g. with 
+    render_PVD_SiC.render_figures for a whole ensemble of runs).
+    nprocs : number of worker processes used to compute the surface height of the frames 
+    (with nprocs > 1 the profiler records all the frames as a single 'frames' stage).
     """
-    import matplotlib.pyplot as plt
+    args = (rundirname, bin_size, surface_roughness, method, plotting, figname, Nexclude, minframes,
+            return_surf_height, return_data, nprocs)
+    if isinstance(profile, RunProfiler):
+        return _analyze_growth_rate(*args, profiler=profile)
+
+    profiler = RunProfiler('growth_rate', enabled=bool(profile))
+    try:
+        return _analyze_growth_rate(*args, profiler=profiler)
+    finally:
+        if isinstance(profile, (str, os.PathLike)):
+            profiler.write_report(profile)
+        else:
+            profiler.write_report(os.path.join(rundirname, 'profile_growth_rate.json'))
+
+def _analyze_growth_rate(rundirname, bin_size, surface_roughness, method, plotting, figname, Nexclude, minframes,
+    return_surf_height, return_data, nprocs, profiler):
+    """ Body of analyze_growth_rate, the stages are recorded in profiler """
     import numpy as np
     from scipy.interpolate import UnivariateSpline
 
     # Firstly, let set the folder where you ran mulskips. 
-    files = read_output_files(rundirname, 'undercoordinated')
+    with profiler.stage('glob'):
+        files = read_output_files(rundirname, 'undercoordinated')
 
     if minframes is None:
         minframes = Nexclude*2 +2
@@ -258,10 +447,15 @@ def analyze_growth_rate(rundirname, bin_size=5.0,surface_roughness=20.0, method=
         # coded in the get_surface_height function.
         # Here we calculate and store the surface height for all output files.
         all_surface_heights = []
-        for file in files:
-            print(file)
-            surface_height  = get_surface_height(file, bin_size, surface_roughness)
-            all_surface_heights.append(surface_height)
+        if nprocs > 1:
+            with profiler.stage('frames'):
+                all_surface_heights = map_frames(_surface_height_job, 
+                    [(file, bin_size, surface_roughness) for file in files], nprocs)
+        else:
+            for i, file in enumerate(files):
+                print(file)
+                surface_height  = get_surface_height(file, bin_size, surface_roughness, profiler=profiler, frame=i)
+                all_surface_heights.append(surface_height)
         # print(all_surface_heights)
         all_surface_heights = np.array(all_surface_heights)
 
@@ -270,17 +464,19 @@ def analyze_growth_rate(rundirname, bin_size=5.0,surface_roughness=20.0, method=
         When you run the mulskips code please store the screen output in the file log.txt:
         <path-of-the-compiled-code>/mulskips.e | tee log.txt
         """
-        def get_time(filename):
-            with open (filename) as f:
-                content = f.read().splitlines()
-                line=content[0]
-                splitline = line.split()
-                time = float(splitline[3]) # KMC time
+        def get_time(filename, frame=None):
+            with profiler.stage('read_time', frame) as rec:
+                with open (filename) as f:
+                    content = f.read().splitlines()
+                    rec['bytes_read'] = f.tell()
+                    line=content[0]
+                    splitline = line.split()
+                    time = float(splitline[3]) # KMC time
             return time
 
         kmc_time_list = []
-        for file in files:
-            time = get_time(file)
+        for i, file in enumerate(files):
+            time = get_time(file, i)
             kmc_time_list.append(time)
         #print(kmc_time_list)
 
@@ -368,7 +564,8 @@ def analyze_growth_rate(rundirname, bin_size=5.0,surface_roughness=20.0, method=
 
                 return gr, (gr_average, gr_average_fit), fitsurfheights
 
-        growth_rate, gr_ave, mysurfheights = get_growth_rate(time_list,all_surface_heights,method)
+        with profiler.stage('fit'):
+            growth_rate, gr_ave, mysurfheights = get_growth_rate(time_list,all_surface_heights,method)
 
         print('\nAverage growth rate for Process ID {}: {} [micron/hour]\n'.format(rundirname,gr_ave))
         # print('Experimental growth rates')
@@ -377,116 +574,151 @@ def analyze_growth_rate(rundirname, bin_size=5.0,surface_roughness=20.0, method=
 
 
 
+    data = {
+        'rundirname': rundirname,
+        'time': time_list,
+        'surface_height': all_surface_heights,
+        'growth_rate': growth_rate,
+        'fit_surface_height': mysurfheights,
+        'growth_rate_average': gr_ave,
+        'Nexclude': Nexclude,
+    }
+
     # Plot surface height and growth rate vs time
     if plotting:
-        plt.figure(figsize=(10, 4))
-        plt.rcParams.update({'font.size': 14})
-
-        plt.subplot(121)
-        plt.plot(time_list, all_surface_heights, 'k-')
-        if mysurfheights is not None:
-            plt.plot(time_list[Nexclude:-Nexclude], mysurfheights, 'r--')
-        plt.ylabel('Surface height [$\AA$]')
-        plt.xlabel('time [s]')
-
-        plt.subplot(122)
-        plt.plot(time_list, growth_rate, 'k-')
-        if isinstance(growth_rate, list) and len(growth_rate) > Nexclude:
-            plt.plot(time_list[Nexclude:-Nexclude], growth_rate[Nexclude:-Nexclude], 'r-')
-        plt.ylabel('Growth rate $\eta$ [micron/hour]')
-        plt.xlabel('time [s]')
-
-        plt.tight_layout()
-        if figname:
-            plt.savefig(f'{figname}.png')
-        else:
-            plt.show()
-        plt.close()
+        with profiler.stage('plot'):
+            import matplotlib.pyplot as plt
+            plt.rcParams.update({'font.size': 14})
+            fig = plt.figure(figsize=(10, 4))
+            draw_growth_rate(fig, data)
+            if figname:
+                fig.savefig(f'{figname}.png')
+            else:
+                plt.show()
+            plt.close(fig)
 
-    if return_surf_height:
+    if return_data:
+        return data
+    elif return_surf_height:
         return gr_ave, all_surface_heights
     else:
         return gr_ave
 
 
+def draw_growth_rate(fig, data):
+    """
+    Draw surface height and growth rate vs time (data as returned by 
+    analyze_growth_rate(return_data=True)) on the matplotlib figure fig.
+    The figure is cleared first, so the same figure can be reused for many runs.
+    """
+    fig.clf()
+    time_list, Nexclude = data['time'], data['Nexclude']
+    growth_rate, mysurfheights = data['growth_rate'], data['fit_surface_height']
+
+    ax = fig.add_subplot(121)
+    ax.plot(time_list, data['surface_height'], 'k-')
+    if mysurfheights is not None:
+        ax.plot(time_list[Nexclude:-Nexclude], mysurfheights, 'r--')
+    ax.set_ylabel('Surface height [$\\AA$]')
+    ax.set_xlabel('time [s]')
+
+    ax = fig.add_subplot(122)
+    ax.plot(time_list, growth_rate, 'k-')
+    if isinstance(growth_rate, list) and len(growth_rate) > Nexclude:
+        ax.plot(time_list[Nexclude:-Nexclude], growth_rate[Nexclude:-Nexclude], 'r-')
+    ax.set_ylabel('Growth rate $\\eta$ [micron/hour]')
+    ax.set_xlabel('time [s]')
+
+    fig.tight_layout()
+    return fig
+
+
 
 # Main function of the notebook to get the coverage out of the xyz
-def get_coverage(filename, mp=None):
+def _species_job(filename):
+    return read_xyz_species_z(filename)[0]
+
+def count_species(files, nprocs=1):
     """
-    CAREFUL: here only H is considered. It Needs some adjustments for whene other cov species are included 
+    Number of atoms of every species in every frame.
+    All frames are integer-coded on a common species list and counted with a 
+    single bincount. Returns (counts, species) with counts of shape (n_frames, n_species).
     """
-    with open(filename) as f:
-        content = f.read().splitlines()
+    frames = map_frames(_species_job, files, nprocs)
+    species, codes = np.unique(np.concatenate(frames) if frames else np.array([], dtype='U2'), return_inverse=True)
+    nsp = len(species)
+    frame_ids = np.repeat(np.arange(len(frames)), [len(f) for f in frames])
+    counts = np.bincount(frame_ids * nsp + codes.ravel(), minlength=len(frames) * nsp)
+    return counts.reshape(len(frames), nsp), species.tolist()
 
-    line=content[0]
-    splitline = line.split()
-    nat = int(splitline[0]) # Total number of atoms
-    #print('nat: {}'.format(nat))
-    line=content[1]
-    splitline = line.split()
-    bc=str(splitline[0])
-    xl=float(splitline[1])
-    yl=float(splitline[2])
-    zl=float(splitline[3])
-    #print(zl)
-    lines=content[2:]
-
-    all_at_species = []
-    for line in lines:
-        splitline = line.split()
-        at=str(splitline[0])
-        x=float(splitline[1])
-        y=float(splitline[2])
-        z=float(splitline[3])
-        all_at_species.append(at)
-    if len(all_at_species) != nat:
-        print('Error: nat and len(all_at_species) do not coincide')
-        sys.exit()
-    
-    coverage_H, coverage_Cl, nvac, nundercoo = 0, 0, 0, 0
-    for ia in all_at_species:
-        # count number of coverages around surface
-        if ia == 'H':
-            coverage_H += 1
-        elif ia == 'Cl':
-            coverage_Cl += 1
-        elif ia == 'O':
-            nvac += 1
-        else:  # this is all undercoordinated crystal atoms (including those surrounding vacancies)
-            nundercoo += 1
-
-    # We do not consider as "surface" the 4 crystal atoms surrounding each vacancy (O atoms in xyz) 
-    surface_atoms = nundercoo - nvac*4   
-
-    # Get number of dangling bonds per surface atom
-    if mp.miller == 100:
-        at2dang = 1.0 #but remember that the max theoretical coverage for Si(100) (num of DBs per Si) is 2; it could be changed in case it's needed
-    else:
-        at2dang = 1.0 #max theoretical coverage for Si(110) and (111) (num of DBs per Si)
-    
-    # Get number of dangling bonds in the KMC box
-    surface_dang_bonds = surface_atoms * at2dang
-    
-    # Get coverage (it should be between 0 and 1)
-    coverage = {'H': [coverage_H / surface_dang_bonds], 'Cl': [coverage_Cl / surface_dang_bonds]}
+
+def get_coverage_array(files, at2dang=1.0, coverage_species=('H', 'Cl'), vacancy_species='O', nprocs=1):
+    """
+    Coverage engine: returns (coverage, species) where coverage has shape 
+    (n_frames, len(coverage_species)) and holds, for every species of coverage_species 
+    (species, in the same order), its number of atoms divided by the number of surface 
+    dangling bonds of the frame (0 if there are none). The number of atoms of all the 
+    species is given by count_species.
+    at2dang : number of dangling bonds per surface atom
+    The surface atoms are all the undercoordinated crystal atoms (neither coverage nor 
+    vacancy species) except the 4 crystal atoms surrounding each vacancy (O atoms in xyz).
+    """
+    counts, species = count_species(files, nprocs)
+    is_cov = np.isin(species, list(coverage_species))
+    is_vac = np.isin(species, [vacancy_species])
+    nvac = counts[:, is_vac].sum(axis=1)
+    nundercoo = counts[:, ~is_cov & ~is_vac].sum(axis=1) # all undercoordinated crystal atoms
+    surface_dang_bonds = (nundercoo - nvac*4) * at2dang
+    cov_counts = np.zeros((len(counts), len(coverage_species)))
+    for n, key in enumerate(coverage_species):
+        if key in species:
+            cov_counts[:, n] = counts[:, species.index(key)]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        coverage = np.where(surface_dang_bonds[:, None] > 0, cov_counts / surface_dang_bonds[:, None], 0.0)
+    return coverage, list(coverage_species)
+
+
+def get_at2dang(mp=None):
+    """ Number of dangling bonds per surface atom for the process class mp """
+    if mp is not None and mp.miller == 100:
+        return 1.0 #but remember that the max theoretical coverage for Si(100) (num of DBs per Si) is 2; it could be changed in case it's needed
+    return 1.0 #max theoretical coverage for Si(110) and (111) (num of DBs per Si)
+
+
+def get_coverage(filename, mp=None, at2dang=None, coverage_species=('H', 'Cl')):
+    """
+    Coverage of a single xyz file, as {species: [coverage]} for each of coverage_species.
+    The normalization at2dang (dangling bonds per surface atom) can be given directly, 
+    otherwise it is taken from the process class mp (see get_at2dang).
+    """
+    if at2dang is None:
+        at2dang = get_at2dang(mp)
+    coverage, species = get_coverage_array([filename], at2dang, coverage_species)
 
     # Instead this is how it would be if normalized to the number of surface dangling bonds in a FLAT surface
     # area_box_KMC = xl*yl*1e-20   # m2
     # coverage = coverage_H / (mp.at_density * area_box_KMC * at2dang)
-    
-    return coverage 
 
+    return {key: [float(coverage[0, n])] for n, key in enumerate(species)}
 
 
-def analyze_coverage(rundirname, plotting=True, figname=None, Nexclude=2, minframes=None, mp=None):
-    
-    import matplotlib.pyplot as plt
+
+def analyze_coverage(rundirname, plotting=True, figname=None, Nexclude=2, minframes=None, mp=None, return_data=False,
+    at2dang=None, coverage_species=('H', 'Cl'), nprocs=1):
+    """
+    Coverage of each species vs time.
+    at2dang : number of dangling bonds per surface atom, if not given it is taken from 
+    the process class mp.
+    return_data : if True, the dict with all the curves (see draw_coverage) is returned 
+    instead of the average coverages.
+    """
     import numpy as np
-    from scipy.interpolate import UnivariateSpline
 
-    if mp is None:
-        print('ERROR: please provide process class argument (mp) in analyze_growth_rate...')
+    if mp is None and at2dang is None:
+        print('ERROR: please provide process class argument (mp) or at2dang in analyze_coverage...')
         sys.exit()
+    if at2dang is None:
+        at2dang = get_at2dang(mp)
 
     # Firstly, let set the folder where you ran mulskips. 
     files = read_output_files(rundirname, 'undercoordinated')
@@ -503,15 +735,9 @@ def analyze_coverage(rundirname, plotting=True, figname=None, Nexclude=2, minfra
         # All the above operation to get z surfave for a given KMC xyz file are 
         # coded in the get_surface_height function.
         # Here we calculate and store the surface height for all output files.
-        # all_surface_coverage = {}
-        for i, file in enumerate(files):
-            print(file)
-            surface_coverage = get_coverage(file, mp)
-            if i==0: 
-                all_surface_coverage = surface_coverage.copy() # will be zeros because first file is I00000000.xyz
-            else:
-                for key in surface_coverage:
-                    all_surface_coverage[key].extend(surface_coverage[key])
+        # The first file (I00000000.xyz) gives zero coverage
+        coverage, species = get_coverage_array(files, at2dang, coverage_species, nprocs=nprocs)
+        all_surface_coverage = {key: coverage[:, n].tolist() for n, key in enumerate(species)}
         #print(all_surface_coverage)
 
         """
@@ -551,32 +777,134 @@ def analyze_coverage(rundirname, plotting=True, figname=None, Nexclude=2, minfra
             coverage_ave[key] = np.mean(np.asarray(all_surface_coverage[key][Nexclude:-Nexclude]))
             print('\nAverage {} coverage for Process ID {}: {} \n'.format(key, rundirname, coverage_ave[key]))
 
+        data = {
+            'rundirname': rundirname,
+            'time': time_list,
+            'coverage': all_surface_coverage,
+            'coverage_average': coverage_ave,
+        }
+
         # Plot stuff
         if plotting:
-            colors = {'Cl':'b', 'H':'g'}
-            # Here we plot the surface height as a zsurfave  as function of the KMC steps and the process time
-            plt.figure(figsize=(10,4))
+            import matplotlib.pyplot as plt
             plt.rcParams.update({'font.size': 14})
-            plt.ticklabel_format(axis='x',style='sci',scilimits=(0,0))
-            for key in all_surface_coverage:
-                plt.plot(time_list, all_surface_coverage[key], '-o', color=colors[key], label=key, alpha=0.5)
-                plt.axhline(coverage_ave[key], color=colors[key], ls=':')
-            plt.ylabel('Coverage')
-            plt.xlabel('time [s]')
-            
-            # plt.title('Process ID: {}'.format(rundirname[:5]))        
-            plt.legend(loc=0)
-            plt.tight_layout()
+            fig = plt.figure(figsize=(10,4))
+            draw_coverage(fig, data)
             if figname is not None:
                 #rundir = os.getcwd() +'/'+rundirname+'/'
                 #plt.savefig('fig-{}-surface_height-growth_rate-time.png'.format(rundirname[:5]))
-                plt.savefig('{}.png'.format(figname))
+                fig.savefig('{}.png'.format(figname))
             else:
                 plt.show()
+            plt.close(fig)
 
+        if return_data:
+            return data
         return coverage_ave
 
 
+def _defect_frame_job(job):
+    """ Counts and depth histogram (below the current surface) of one defects/wrong frame """
+    filename, surface_height, depth_bin = job
+    species, z, box = read_xyz_species_z(filename)
+    depth_edges = np.arange(0.0, box[2] + depth_bin, depth_bin)
+    depth = np.clip(surface_height - z, 0.0, None) # atoms above the average surface go in the first bin
+    hist, _ = np.histogram(depth, bins=depth_edges)
+    names, counts = np.unique(species, return_counts=True)
+    return len(z), dict(zip(names.tolist(), counts.tolist())), hist, depth_edges, box
+
+
+def analyze_defects(rundirname, what='defects', bin_size=2.0, surface_roughness=10.0, depth_bin=5.0,
+    nprocs=1, surface_heights=None):
+    """
+    Time series of the defect (what='defects', *_d.xyz files) or wrong-atom 
+    (what='wrong', *_w.xyz files, i.e. antisites) statistics of a run.
+    For every frame it returns the number of atoms (total and per species), their 
+    distribution in depth below the surface height of the same frame (histogram with 
+    bins of depth_bin Angstroem), and their density normalized to the thickness 
+    deposited so far (surface height minus the one of the first frame).
+    The frames are processed with the same pipeline (map_frames) as analyze_growth_rate.
+    bin_size, surface_roughness : used to get the surface height (see get_surface_height), 
+    unless the surface heights of all frames are given in surface_heights.
+    """
+    if what not in ['defects', 'wrong']:
+        print("ERROR: what should one of the following: 'defects', 'wrong'")
+        sys.exit()
+
+    files = read_output_files(rundirname, what)
+    undercoo = {frame_index(f): f for f in read_output_files(rundirname, 'undercoordinated')}
+    files = [f for f in files if frame_index(f) in undercoo]
+    if len(files) == 0:
+        print('ERROR: no \'{}\' files with a matching undercoordinated frame in {}'.format(what, rundirname))
+        return None
+    frames = [frame_index(f) for f in files]
+    undercoo_files = [undercoo[i] for i in frames]
+
+    # Surface height and KMC time of each frame come from the undercoordinated files
+    if surface_heights is None:
+        surface_heights = map_frames(_surface_height_job, 
+            [(f, bin_size, surface_roughness) for f in undercoo_files], nprocs)
+    surface_heights = np.asarray(surface_heights, dtype=float)
+    time_list = np.array([get_kmc_time(f) for f in undercoo_files])
+
+    results = map_frames(_defect_frame_job, 
+        [(f, h, depth_bin) for f, h in zip(files, surface_heights)], nprocs)
+
+    count = np.array([r[0] for r in results])
+    all_species = sorted(set(sp for r in results for sp in r[1]))
+    species = {sp: np.array([r[1].get(sp, 0) for r in results]) for sp in all_species}
+    nbins = max(len(r[2]) for r in results)
+    depth_histogram = np.zeros((len(results), nbins), dtype=int)
+    for i, r in enumerate(results):
+        depth_histogram[i, :len(r[2])] = r[2]
+    depth_edges = max((r[3] for r in results), key=len)
+    xl, yl = results[0][4][0], results[0][4][1]
+
+    # Density normalized to the deposited thickness [cm^-3] (undefined before any growth)
+    thickness = surface_heights - surface_heights[0] # Angstroem
+    with np.errstate(divide='ignore', invalid='ignore'):
+        density = np.where(thickness > 0, count / (xl * yl * thickness) * 1e24, np.nan)
+
+    print('\nNumber of \'{}\' atoms in the last frame for Process ID {}: {} ({:.3e} cm^-3)\n'.format(
+        what, rundirname, count[-1], density[-1]))
+
+    return {
+        'rundirname': rundirname,
+        'what': what,
+        'frame': np.array(frames),
+        'time': time_list,
+        'surface_height': surface_heights,
+        'thickness': thickness,
+        'count': count,
+        'species': species,
+        'density': density,
+        'depth_edges': depth_edges,
+        'depth_histogram': depth_histogram,
+    }
+
+
+def draw_coverage(fig, data):
+    """
+    Draw the coverage of each species vs time (data as returned by 
+    analyze_coverage(return_data=True)) on the matplotlib figure fig, after clearing it.
+    """
+    colors = {'Cl':'b', 'H':'g'}
+    fig.clf()
+    # Here we plot the surface height as a zsurfave  as function of the KMC steps and the process time
+    ax = fig.add_subplot(111)
+    ax.ticklabel_format(axis='x',style='sci',scilimits=(0,0))
+    for key in data['coverage']:
+        ax.plot(data['time'], data['coverage'][key], '-o', color=colors.get(key), label=key, alpha=0.5)
+        ax.axhline(data['coverage_average'][key], color=colors.get(key), ls=':')
+    ax.set_ylabel('Coverage')
+    ax.set_xlabel('time [s]')
+
+    # ax.set_title('Process ID: {}'.format(data['rundirname'][:5]))
+    ax.legend(loc=0)
+    fig.tight_layout()
+    return fig
+
+
 def count_vacancies(dirname):
     import glob
     # Loop through all files ending with "_v.xyz"
@@ -0,0 +1,402 @@
+"""
+Headless driver of the PVD SiC workflow (simulation -> analysis -> NeXus).
+
+Same pipeline as Parser_May_0.ipynb, without any input() prompt, so that it can
+run on a batch node and many jobs can be queued back to back. Parameters come
+from a JSON parameter file and/or from the command line (command line wins):
+
+    python batch_PVD_SiC.py --params run153.json --randseed 42
+    python batch_PVD_SiC.py --sample-id 153 --lenx 60 --leny 60 --lenz 960 \\
+        --execpath /path/to/mulskips-source
+
+Heavy modules (numpy, h5py, pymulskips, matplotlib) are imported only inside
+the stage that needs them, so `--help` and argument errors return immediately.
+"""
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import traceback
+
+# Reference samples (same as in the notebook)
+DATA_SAMPLES = {
+    '153': {
+        'Power': 6.10,
+        'T_seed_middle': 2072.24,
+        'T_seed_edge': 0,
+        'T_source_middle': 2080.20,
+        'T_source_edge': 2080.20,
+        'Exp-Growth-Rate': 287
+    }
+}
+
+# Default run parameters (same defaults proposed by ask_value in the notebook)
+DEFAULTS = {
+    'sample_id': '153',
+    'lenx': 60,
+    'leny': 60,
+    'lenz': 960,
+    'randseed': 9117116,
+    'newdT': 0.0,
+    'dT': 100.0,
+    'method': 'polyfit',
+    'bin_size': 2.0,
+    'surface_roughness': 10.0,
+    'Nexclude': 2,
+    'Nout': 50,
+    'execpath': os.environ.get('MULSKIPS_EXECPATH'),
+    'runpath': None,
+    'nexus_file': None,
+    'skip_simulation': False,
+    'profile': False,
+}
+
+KMC_LATTICE_CONSTANT = 0.436 / 12  # nm
+ALAT = 4.36  # Angstrom
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run the MulSKIPS PVD SiC workflow non-interactively.')
+    parser.add_argument('--params', help='JSON file with the run parameters (keys as the options below, with underscores)')
+    parser.add_argument('--sample-id', dest='sample_id', choices=sorted(DATA_SAMPLES))
+    parser.add_argument('--lenx', type=int)
+    parser.add_argument('--leny', type=int)
+    parser.add_argument('--lenz', type=int)
+    parser.add_argument('--randseed', type=int)
+    parser.add_argument('--newdT', type=float, help='additional temperature shift [K]')
+    parser.add_argument('--dT', type=float, help='delta T added to Tsource [K]')
+    parser.add_argument('--method', choices=['finitediff', 'spline', 'polyfit', 'finiteANDfit'])
+    parser.add_argument('--bin-size', dest='bin_size', type=float, help='[Angstrom]')
+    parser.add_argument('--surface-roughness', dest='surface_roughness', type=float, help='[Angstrom]')
+    parser.add_argument('--Nexclude', type=int)
+    parser.add_argument('--Nout', type=int, help='number of output frames')
+    parser.add_argument('--execpath', help='MulSKIPS source folder (default: $MULSKIPS_EXECPATH)')
+    parser.add_argument('--runpath', help='run folder (default: parser/data-<dT>-<newdT>-<randseed>)')
+    parser.add_argument('--nexus-file', dest='nexus_file', help='output NeXus file (default: SiC_sample_<sample_id>.nxs)')
+    parser.add_argument('--skip-simulation', dest='skip_simulation', action='store_true', default=None,
+                        help='only analyze an existing run folder and write the NeXus file')
+    parser.add_argument('--profile', action='store_true', default=None,
+                        help='write profile_growth_rate.json in the run folder')
+    args = parser.parse_args(argv)
+
+    params = dict(DEFAULTS)
+    if args.params:
+        with open(args.params) as f:
+            from_file = json.load(f)
+        unknown = set(from_file) - set(DEFAULTS)
+        if unknown:
+            parser.error('unknown keys in {}: {}'.format(args.params, ', '.join(sorted(unknown))))
+        params.update(from_file)
+    params.update({k: v for k, v in vars(args).items() if k != 'params' and v is not None})
+
+    params['sample_id'] = str(params['sample_id'])
+    if params['sample_id'] not in DATA_SAMPLES:
+        parser.error('unknown sample_id {}'.format(params['sample_id']))
+    if not params['skip_simulation'] and not params['execpath']:
+        parser.error('--execpath (or $MULSKIPS_EXECPATH) is required to run the simulation')
+    return params
+
+
+def derived_quantities(params):
+    """ Temperatures, total time and folders derived from the run parameters """
+    data = dict(DATA_SAMPLES[params['sample_id']])
+    dT, newdT = params['dT'], params['newdT']
+    tseed = data['T_seed_middle'] + 273.15 + newdT
+    tsource_0 = data['T_source_middle'] + 273.15 + newdT
+    tsource = tsource_0 + dT
+    gr = data['Exp-Growth-Rate'] * (dT / 25 if dT != 0 else 1)
+    target_thickness = 0.90 * params['lenz'] * KMC_LATTICE_CONSTANT * 1e-3
+    tottime = 3600 * target_thickness / gr
+    runpath = params['runpath'] or f"parser/data-{dT}-{newdT}-{params['randseed']}"
+    nexus_file = params['nexus_file'] or f"SiC_sample_{params['sample_id']}.nxs"
+    return {
+        'data': data,
+        'tseed': tseed,
+        'tsource_0': tsource_0,
+        'tsource': tsource,
+        'gr': gr,
+        'target_thickness': target_thickness,
+        'tottime': tottime,
+        'runpath': runpath,
+        'nexus_file': nexus_file,
+        'surf_file': os.path.join(runpath, "surf_height.txt"),
+        'xyz_file': os.path.join(runpath, f"{params['randseed']}_v.xyz"),
+        'results_file': os.path.join(runpath, "results.txt"),
+        'logfile': os.path.join(runpath, "runlog.txt"),
+    }
+
+
+def run_simulation(params, der):
+    from pymulskips.setuprun import setup_mulskips_src, run_mulskips
+    from pymulskips import setuprun, process
+
+    os.makedirs(der['runpath'], exist_ok=True)
+    setup_mulskips_src(params['execpath'], params['lenx'], params['leny'], params['lenz'])
+    pvdclass = process.PVD(substrate='SiC-3C', precursors=['Si', 'Si2C', 'SiC2'],
+                           calibration_type='avrov', Tsource=der['tsource'], Tseed_center=der['tseed'])
+    setuprun.RunType = 'R'
+    setuprun.IDUM = params['randseed']
+    setuprun.setup_only = False
+    setuprun.TotTime = der['tottime']
+    setuprun.OutTime = der['tottime'] / params['Nout']
+    setuprun.OutMolMol = 1
+    setuprun.Seed_box = [48, 0, 0]
+    run_mulskips(params['execpath'], der['runpath'], 'F', pvdclass,
+                 PtransZig=0.93, ExitStrategy='Time', SaveCoo=False)
+
+
+def merge_xyz_files(dirname, outfile):
+    files = sorted(f for f in os.listdir(dirname) if f.startswith("I") and f.endswith(".xyz"))
+    with open(outfile, "w") as out:
+        for f in files:
+            path = os.path.join(dirname, f)
+            with open(path, "r") as fin:
+                out.write(fin.read() + "\n")
+
+
+def run_analysis(params, der):
+    import numpy as np
+    from analyze_PVD_SiC_0 import analyze_growth_rate, count_vacancies, read_output_files
+
+    runpath = der['runpath']
+    surf_heights = []
+    try:
+        growth_rate, surf_heights = analyze_growth_rate(
+            runpath, method=params['method'], return_surf_height=True,
+            surface_roughness=params['surface_roughness'], bin_size=params['bin_size'],
+            Nexclude=params['Nexclude'], plotting=False, profile=params['profile'])
+
+        if (not np.isfinite(growth_rate)) or (hasattr(surf_heights, '__len__') and len(surf_heights) < 3):
+            raise ValueError("Growth rate is NaN, infinite or computed on too few frames")
+        avg_surf_height = float(np.mean(surf_heights))
+
+        # Save surf_height.txt
+        files = read_output_files(runpath, 'undercoordinated')
+        if len(files) == len(surf_heights):
+            time_list = []
+            for file in files:
+                with open(file) as f:
+                    time_list.append(float(f.readline().split()[3]))
+            nu = 1.0
+            time_list = [t * nu for t in time_list]
+            with open(der['surf_file'], "w") as f:
+                for t, h in zip(time_list, surf_heights):
+                    f.write(f"{t:.6e} {h*1e-4:.6e}\n")
+            print(f"✔️ Created {der['surf_file']}")
+        else:
+            print("⚠️ Number of .xyz files and surface heights do not coincide")
+
+    except Exception as e:
+        print(f"⚠️ Growth rate failed: {e}")
+        growth_rate, avg_surf_height = np.nan, np.nan
+
+    vac_data = count_vacancies(runpath)
+    print(vac_data)
+
+    try:
+        subprocess.run(f"cat {runpath}/start.dat > {der['logfile']}", shell=True, check=True)
+    except Exception as e:
+        print(f"⚠️ Log failed: {e}")
+
+    if not os.path.exists(der['xyz_file']):
+        try:
+            merge_xyz_files(runpath, der['xyz_file'])
+            print(f"✔️ Created {der['xyz_file']}")
+        except Exception as e:
+            print(f"⚠️ Merge .xyz failed: {e}")
+
+    if not os.path.exists(der['results_file']) and not np.isnan(growth_rate):
+        try:
+            with open(der['results_file'], "w") as f:
+                f.write(f"growth_rate [micron/hour] = {growth_rate:.6f}\n")
+            print(f"✔️ Created {der['results_file']}")
+        except Exception as e:
+            print(f"⚠️ Writing results failed: {e}")
+
+    if not os.path.exists(der['logfile']) and not np.isnan(avg_surf_height):
+        try:
+            with open(der['logfile'], "w") as f:
+                f.write(f"Automatically created log\navg_surf_height = {avg_surf_height:.3f} Å\n")
+            print(f"✔️ Created {der['logfile']}")
+        except Exception as e:
+            print(f"⚠️ Writing log failed: {e}")
+
+    return {'growth_rate': growth_rate, 'surf_heights': surf_heights, 'vac_data': vac_data}
+
+
+def read_file(path):
+    with open(path) as f:
+        return f.read()
+
+
+def set_ds(group, name, value, unit=None):
+    ds = group.create_dataset(name, data=value)
+    if unit:
+        ds.attrs['units'] = unit
+    return ds
+
+
+def write_nexus(params, der, res_data):
+    import numpy as np
+    import h5py
+
+    data = der['data']
+    growth_rate, surf_heights, vac_data = res_data['growth_rate'], res_data['surf_heights'], res_data['vac_data']
+    sample_id, runpath = params['sample_id'], der['runpath']
+    with h5py.File(der['nexus_file'], 'w') as f:
+        f.attrs['NX_class'] = 'NXroot'
+        f.create_dataset('default', data=b'NXmicrostructure_imm_results')
+
+        def grp(name):
+            g = f.create_group(name)
+            g.attrs['NX_class'] = name
+            return g
+
+        software = grp('NXsoftware')
+        set_ds(software, 'name', b'MulSKIPS')
+        set_ds(software, 'version', b'1.0')
+        set_ds(software, 'description', b'Multiscale KMC for PVD SiC')
+
+        user = grp('NXuser')
+        set_ds(user, 'name', b'Filippo Ruberto')
+        set_ds(user, 'affiliation', b'CNR-IMM@CT')
+        set_ds(user, 'email', b'filippo.ruberto@cnr.it')
+        set_ds(user, 'ORCID', b'0000-0002-1234-5678')
+
+        project = grp('NXproject')
+        set_ds(project, 'name', b'MulSKIPS@CNR-IMM')
+        set_ds(project, 'description', b'Multiscale modeling of PVD growth of SiC')
+        set_ds(project, 'grant_number', b'FAIRmat-NFDI')
+
+        prov = grp('NXprovenance')
+        set_ds(prov, 'source', b'https://github.com/mulskips/mulskips-source')
+        set_ds(prov, 'modification_date', str(datetime.datetime.now()))
+
+        conf = grp('NXmicrostructure_imm_config')
+        set_ds(conf, 'power', data['Power'], 'W')
+        set_ds(conf, 'temperature_seed', der['tseed'], 'K')
+        set_ds(conf, 'temperature_source', der['tsource'], 'K')
+        set_ds(conf, 'initial_temperature_source', der['tsource_0'], 'K')
+        set_ds(conf, 'temperature_difference', params['dT'], 'K')
+        set_ds(conf, 'additional_temperature_shift', params['newdT'], 'K')
+        set_ds(conf, 'geometry/lenx', params['lenx'], 'lattice units')
+        set_ds(conf, 'geometry/leny', params['leny'], 'lattice units')
+        set_ds(conf, 'geometry/lenz', params['lenz'], 'lattice units')
+        set_ds(conf, 'KMC_lattice_constant', KMC_LATTICE_CONSTANT, 'nm')
+        set_ds(conf, 'alat_angstrom', ALAT, 'Angstrom')
+        set_ds(conf, 'simulation_type', b'PVD')
+        set_ds(conf, 'substrate_material', b'SiC-3C')
+        conf.create_dataset('precursors', data=np.array([b'Si', b'Si2C', b'SiC2']))
+        set_ds(conf, 'experiment_identifier', f'PVD-SiC-Run-{sample_id}'.encode())
+        set_ds(conf, 'deposition_time', der['tottime'], 's')
+        set_ds(conf, 'output_steps', params['Nout'])
+        set_ds(conf, 'target_thickness', der['target_thickness'], 'mm')
+        set_ds(conf, 'random_seed', params['randseed'])
+        set_ds(conf, 'timestamp', str(datetime.datetime.now()))
+        set_ds(conf, 'run_directory', runpath.encode())
+
+        set_ds(conf, 'simulation_parameters/PtransZig', 0.93)
+        set_ds(conf, 'simulation_parameters/ExitStrategy', b'Time')
+        set_ds(conf, 'simulation_parameters/SaveCoo', b'False')
+        conf.create_dataset('simulation_parameters/Seed_box', data=[48, 0, 0])
+        set_ds(conf, 'simulation_parameters/setup_only', b'False')
+        set_ds(conf, 'analysis/bin_size', params['bin_size'], 'cm')
+        set_ds(conf, 'analysis/surface_roughness', params['surface_roughness'])
+        set_ds(conf, 'analysis/Nexclude', params['Nexclude'])
+
+        res = grp('NXmicrostructure_imm_results')
+        set_ds(res, 'growth_rate', 0.0 if np.isnan(growth_rate) else growth_rate, 'micron/hour')
+        avg_val = float(np.mean(surf_heights)) if hasattr(surf_heights, '__len__') and len(surf_heights) else 0.0
+        set_ds(res, 'avg_surface_height', avg_val, 'micron')
+        set_ds(res, 'growth_rate_method', np.bytes_(params['method']))
+        set_ds(res, 'experimental_growth_rate', data['Exp-Growth-Rate'], 'micron/hour')
+        set_ds(res, 'alat_used', ALAT, 'Angstrom')
+        set_ds(res, 'analysis_time', str(datetime.datetime.now()))
+        set_ds(res, 'total_time', der['tottime'], 's')
+        set_ds(res, 'num_outputs', params['Nout'])
+        set_ds(res, 'target_thickness', der['target_thickness'], 'mm')
+        set_ds(res, 'vacancies_total', vac_data.get('tot', -1))
+
+        for k, v in vac_data.items():
+            set_ds(res, f'vacancy_{k}', v)
+
+        if os.path.exists(der['xyz_file']):
+            set_ds(res, 'xyz_file', np.bytes_(der['xyz_file']))
+
+        try:
+            if os.path.exists(der['results_file']):
+                results_txt = read_file(der['results_file'])
+                set_ds(res, 'results_txt', np.bytes_(results_txt))
+
+                lines = results_txt.strip().splitlines()
+                hdrs_line = next((l.lstrip("# ") for l in lines if l.strip().startswith("#") and any(k in l for k in ["Tsource", "GR", "conc"])), None)
+                hdrs = hdrs_line.split() if hdrs_line else []
+                data_rows = []
+                for l in lines:
+                    if l.strip().startswith('#') or not l.strip():
+                        continue
+                    try:
+                        nums = list(map(float, l.split()))
+                        if len(nums) == len(hdrs):
+                            data_rows.append(nums)
+                    except ValueError:
+                        continue
+                if data_rows and hdrs:
+                    data_mat = np.array(data_rows)
+                    for i, h in enumerate(hdrs):
+                        set_ds(res, f'results_table/{h}', data_mat[:, i])
+                else:
+                    print("⚠️ results.txt table is empty or without valid numeric data.")
+        except Exception as e:
+            print(f"⚠️ results.txt table failed: {e}")
+
+        try:
+            if os.path.exists(der['surf_file']):
+                txt = read_file(der['surf_file'])
+                try:
+                    tab = np.loadtxt(der['surf_file'])
+                    if tab.ndim == 1:
+                        tab = tab.reshape(-1, 2)
+                    set_ds(res, 'surf_height_txt', np.bytes_(txt))
+                    set_ds(res, 'surf_height/time', tab[:, 0], 's')
+                    set_ds(res, 'surf_height/height', tab[:, 1], 'micron')
+                except Exception as parse_err:
+                    print(f"⚠️ Error parsing surf_height.txt: {parse_err}")
+                    set_ds(res, 'surf_height_txt', np.bytes_(txt))
+        except Exception as e:
+            print(f"⚠️ surf_height.txt failed: {e}")
+            set_ds(res, 'surf_height_txt', np.bytes_("null"))
+
+        log = grp('simulation_log')
+        log_txt = read_file(der['logfile']) if os.path.exists(der['logfile']) else ""
+        set_ds(log, 'description', b'MulSKIPS simulation log')
+        set_ds(log, 'data', np.bytes_(log_txt))
+
+    print(f"✅ NeXus file written: {der['nexus_file']}")
+
+
+def main(argv=None):
+    params = parse_args(argv)
+    der = derived_quantities(params)
+    print('Run parameters: {}'.format(json.dumps(params, sort_keys=True)))
+
+    if not params['skip_simulation']:
+        run_simulation(params, der)
+    elif not os.path.isdir(der['runpath']):
+        print('ERROR: run folder {} does not exist'.format(der['runpath']))
+        return 1
+
+    res_data = run_analysis(params, der)
+    try:
+        write_nexus(params, der, res_data)
+    except Exception as e:
+        print(f"❌ Error writing the NeXus file: {e}")
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
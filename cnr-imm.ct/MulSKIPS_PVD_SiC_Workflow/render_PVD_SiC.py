@@ -0,0 +1,80 @@
+"""
+Off-screen rendering of the analysis figures for ensembles of runs.
+
+The analyses compute, this module draws: collect the results with
+    analyze_growth_rate(rundir, ..., plotting=False, return_data=True)
+    analyze_coverage(rundir, ..., plotting=False, return_data=True)
+and turn all of them into PNGs in parallel worker processes with
+
+    render_figures(results, outdir, kind='growth_rate', nprocs=8)
+
+Workers use the non-interactive Agg canvas (no pyplot global state, the backend
+and rcParams of the caller are left untouched) and keep one figure per kind,
+which is cleared and redrawn for every run instead of being rebuilt.
+"""
+import os
+import multiprocessing
+
+from analyze_PVD_SiC_0 import draw_growth_rate, draw_coverage
+
+DRAWERS = {
+    'growth_rate': draw_growth_rate,
+    'coverage': draw_coverage,
+}
+FIGSIZE = (10, 4)
+
+# One figure per kind, created lazily in each worker process and then reused
+_figures = {}
+
+
+def _get_figure(kind):
+    if kind not in _figures:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        fig = Figure(figsize=FIGSIZE)
+        FigureCanvasAgg(fig)
+        _figures[kind] = fig
+    return _figures[kind]
+
+
+def _render_one(job):
+    kind, data, outfile, dpi, font_size = job
+    import matplotlib
+    fig = _get_figure(kind)
+    with matplotlib.rc_context({'font.size': font_size}):
+        DRAWERS[kind](fig, data)
+        fig.savefig(outfile, dpi=dpi)
+    return outfile
+
+
+def figure_name(data, kind):
+    return '{}-{}.png'.format(os.path.basename(os.path.normpath(data['rundirname'])), kind)
+
+
+def render_figures(results, outdir='.', kind='growth_rate', nprocs=None, dpi=100, font_size=14):
+    """
+    Render one PNG per element of results (dicts returned by the analyses with
+    return_data=True) in outdir, using nprocs worker processes (default: all cores).
+    The results without data (the analyses return 0 for runs with too few frames) are skipped.
+    Returns the list of written files, in the same order as results.
+    """
+    if kind not in DRAWERS:
+        print('ERROR: kind should be one of the following: {}'.format(', '.join(DRAWERS)))
+        return []
+    os.makedirs(outdir, exist_ok=True)
+    skipped = sum(1 for data in results if not isinstance(data, dict))
+    if skipped:
+        print('WARNING: skipping {} results without data'.format(skipped))
+    jobs = [(kind, data, os.path.join(outdir, figure_name(data, kind)), dpi, font_size)
+            for data in results if isinstance(data, dict)]
+    if not jobs:
+        return []
+
+    nprocs = min(nprocs or os.cpu_count() or 1, len(jobs))
+    if nprocs == 1:
+        return [_render_one(job) for job in jobs]
+
+    # 'spawn' avoids inheriting an interactive backend (or an open GUI) from a notebook kernel
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(nprocs) as pool:
+        return pool.map(_render_one, jobs, chunksize=max(1, len(jobs) // (4 * nprocs)))
@@ -1,18 +1,239 @@
+import io
 import os
+import json
+import base64
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 import time
-from functools import wraps
-
-def delayed_call(delay_seconds):
-    """Decorator that delays the call to the wrapped function by delay_seconds."""
-    def decorator(func):
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            time.sleep(delay_seconds)
-            return func(*args, **kwargs)
-        return wrapper
-    return decorator
+import shutil
+import random
+import threading
+from pathlib import Path
+from contextlib import nullcontext
+
+from tracing import span
+
+# Lab NOMAD server, can be overridden with the NOMAD_URL environment variable (e.g. nomad_stub_server.py)
+NOMAD_URL = os.environ.get('NOMAD_URL', 'http://192.168.157.46:8000/fairdi/nomad/latest/api/v1/')
+
+# Polling of the upload processing: the first poll is fast, then the interval grows
+# by POLL_BACKOFF (with +-POLL_JITTER random spread) up to POLL_MAX_INTERVAL.
+# The timeout scales with the upload size: POLL_BASE_TIMEOUT + POLL_TIMEOUT_PER_MB * MB
+POLL_FIRST_INTERVAL = 0.5
+POLL_MAX_INTERVAL = 10
+POLL_BACKOFF = 1.6
+POLL_JITTER = 0.2
+POLL_BASE_TIMEOUT = 60
+POLL_TIMEOUT_PER_MB = 2
+
+# Uploads are streamed in UPLOAD_CHUNK_SIZE chunks, each one must go through within
+# UPLOAD_CHUNK_TIMEOUT seconds (instead of a timeout on the whole upload).
+# Zip files on disk larger than RESUMABLE_PART_SIZE are uploaded in resumable parts (see upload_resumable).
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_CHUNK_TIMEOUT = 30
+RESUMABLE_PART_SIZE = 100 * 1024 * 1024
+
+# Archives are zipped in memory up to ARCHIVE_SPOOL_SIZE bytes (then in a temporary file).
+# Indented archives are serialized by SERIALIZE_WORKERS processes (a pool started once per process)
+# when there are at least SERIALIZE_PARALLEL_MIN of them. Measured on step archives of ~0.5 kB:
+# ~14 us each to indent against ~5 ms per batch and ~1.5 us per archive to pass them to the pool,
+# so the pool pays off from about a thousand archives. Compact JSON (~6 us) is always encoded
+# in the calling process: passing it to the pool costs more than encoding it.
+ARCHIVE_SPOOL_SIZE = 64 * 1024 * 1024
+SERIALIZE_WORKERS = min(4, os.cpu_count() or 1)
+SERIALIZE_PARALLEL_MIN = 1000
+
+# Entries listing: page size and max number of pages fetched concurrently
+ENTRIES_PAGE_SIZE = 100
+ENTRIES_PAGE_WORKERS = 4
+
+# Tokens are refreshed TOKEN_REFRESH_MARGIN seconds before they expire. When the expiry
+# cannot be read from the token (not a JWT), it is assumed to last TOKEN_DEFAULT_LIFETIME.
+TOKEN_REFRESH_MARGIN = 60
+TOKEN_DEFAULT_LIFETIME = 300
+
+
+def normalize_url(nomad_url):
+    '''Base URL of the API with the trailing slash, the key of the shared clients and token caches.'''
+    return nomad_url if nomad_url.endswith('/') else nomad_url + '/'
+
+def token_expiry(token):
+    '''Expiry (unix time) read from the "exp" claim of a JWT token, None if not available.
+    The signature is not verified: the value is only used to know when to refresh.'''
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except Exception:
+        return None
+
+
+class TokenCache:
+    """
+    Thread-safe cache of the access token of a NOMAD API, so that consecutive
+    (or concurrent) uploads share a single token instead of authenticating each time.
+    The token is refreshed refresh_margin seconds before it expires.
+    """
+    def __init__(self, nomad_url, refresh_margin=TOKEN_REFRESH_MARGIN, default_lifetime=TOKEN_DEFAULT_LIFETIME):
+        self.nomad_url = nomad_url
+        self.refresh_margin = refresh_margin
+        self.default_lifetime = default_lifetime
+        self.token = None
+        self.expires_at = 0
+        self._lock = threading.Lock()
+
+    def _fetch(self):
+        token, success = get_authentication_token(self.nomad_url)
+        if not success:
+            self.token, self.expires_at = None, 0
+            return None
+        self.token = token
+        self.expires_at = token_expiry(token) or time.time() + self.default_lifetime
+        return token
+
+    def get(self):
+        '''Return a valid token, authenticating only if the cached one is missing or expiring.'''
+        with self._lock:
+            if self.token is None or time.time() > self.expires_at - self.refresh_margin:
+                return self._fetch()
+            return self.token
+
+    def refresh(self, stale_token=None):
+        '''Force a new token (e.g. after a 401). If another thread has already replaced
+        stale_token, its new token is returned without authenticating again.'''
+        with self._lock:
+            if self.token is None or stale_token is None or self.token == stale_token:
+                return self._fetch()
+            return self.token
+
+
+class NomadClient:
+    """
+    Keep-alive HTTP client for a NOMAD API.
+
+    It owns a pooled requests.Session with the base URL and the auth header set once,
+    so that consecutive calls (e.g. the status polling) reuse the same TCP connection.
+    Transient failures (connection errors, 429 and 5xx) are retried with exponential
+    backoff (backoff_factor * 2**n seconds) up to `retries` times. POST requests are
+    retried only on connection errors, since an upload may not be idempotent.
+
+    Args:
+        nomad_url (str): Base URL of the NOMAD API (e.g. NOMAD_URL).
+        token (str): Bearer authentication token, can be set later with set_token.
+        retries (int): Retry budget for each request.
+        backoff_factor (float): Base of the exponential backoff between retries [s].
+        pool_maxsize (int): Max number of pooled connections (i.e. concurrent requests).
+        timeout (float): Default timeout of each request [s].
+    """
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, nomad_url=NOMAD_URL, token=None, retries=3, backoff_factor=0.5,
+                 pool_maxsize=10, timeout=30):
+        self.nomad_url = normalize_url(nomad_url)
+        self.timeout = timeout
+        self.token = None
+        self.tokens = TokenCache(self.nomad_url)
+        # upload_id -> observed latencies (see record_upload)
+        self.upload_stats = {}
+        self._stats_lock = threading.Lock()
+
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=self.RETRY_STATUS,
+            allowed_methods=frozenset({'GET', 'HEAD', 'OPTIONS', 'DELETE'}),
+            raise_on_status=False,  # the last response is returned, callers use raise_for_status
+            respect_retry_after_header=True,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Accept': 'application/json'})
+        if token:
+            self.set_token(token)
+
+    def set_token(self, token):
+        self.token = token
+        self.session.headers['Authorization'] = f'Bearer {token}'
+
+    def get_token(self):
+        '''Cached access token (see TokenCache), also set as the session auth header.'''
+        token = self.tokens.get()
+        if token and token != self.token:
+            self.set_token(token)
+        return token
+
+    def request(self, method, path, token=None, body=None, **kwargs):
+        """Send a request to nomad_url + path with the cached token (see TokenCache), refreshed
+        before it expires; token is used only if the cache has none (e.g. a token set by hand),
+        for this request only. On a 401 the token is refreshed and the request is retried once.
+        body is a function returning the request data, called again for the retry: streamed
+        bodies (generators of chunks) can be sent only once."""
+        kwargs.setdefault('timeout', self.timeout)
+        if path != 'auth/token' and self.tokens.token is not None:
+            token = self.get_token() or token
+        used_token = token or self.token
+        if token and token != self.token:
+            kwargs['headers'] = {**kwargs.get('headers', {}), 'Authorization': f'Bearer {token}'}
+        if body is not None:
+            kwargs['data'] = body()
+        response = self.session.request(method, self.nomad_url + path, **kwargs)
+
+        if response.status_code != 401 or path == 'auth/token':
+            return response
+        # a body that was already consumed (e.g. an open file) must be rebuilt or rewound to be sent again
+        data = kwargs.get('data')
+        if body is not None:
+            kwargs['data'] = body()
+        elif data is not None and not isinstance(data, (bytes, str, dict)):
+            if not hasattr(data, 'seek'):
+                return response
+            data.seek(0)
+        new_token = self.tokens.refresh(used_token)
+        if not new_token:
+            return response
+        self.set_token(new_token)
+        kwargs['headers'] = {**kwargs.get('headers', {}), 'Authorization': f'Bearer {new_token}'}
+        return self.session.request(method, self.nomad_url + path, **kwargs)
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+    def record_upload(self, upload_id, **fields):
+        """Store measurements of an upload: size, upload_time, processing_time, polls,
+        total_time (end-to-end latency, from the POST to the fetched entries) [s]."""
+        with self._stats_lock:
+            self.upload_stats.setdefault(upload_id, {}).update(fields)
+
+    def close(self):
+        self.session.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(nomad_url=NOMAD_URL, token=None):
+    """Return the shared NomadClient for nomad_url (created on first use)."""
+    nomad_url = normalize_url(nomad_url)
+    with _clients_lock:
+        client = _clients.get(nomad_url)
+        if client is None:
+            client = _clients[nomad_url] = NomadClient(nomad_url)
+        if token and client.token is None:
+            client.set_token(token)
+    return client
 
 # def get_authentication_token(nomad_url):
 #     '''Get the token for accessing your NOMAD unpublished uploads remotely'''
@@ -32,13 +253,14 @@ def delayed_call(delay_seconds):
 #         print(f'something went wrong trying to get authentication token:\n{e}')
 #         return None, False
 def get_authentication_token(nomad_url):
-    '''Get the token for accessing your NOMAD unpublished uploads remotely'''
-    username = ''  # Consider moving to environment variables
-    password = ''      # Consider moving to environment variables
+    '''Get the token for accessing your NOMAD unpublished uploads remotely.
+    Use get_client(nomad_url).get_token() to reuse a cached token instead.'''
+    username = os.environ.get('NOMAD_USERNAME', '')
+    password = os.environ.get('NOMAD_PASSWORD', '')
 
     try:
-        response = requests.get(
-            nomad_url + 'auth/token', 
+        response = get_client(nomad_url).get(
+            'auth/token', 
             params=dict(username=username, password=password), 
             timeout=10
         )
@@ -85,21 +307,125 @@ def get_authentication_token(nomad_url):
 #         except Exception as e:
 #             print(f'something went wrong uploading to NOMAD:\n{e}')
 #             return
-@delayed_call(delay_seconds=5)  # waits 5 seconds before execution
-def upload_to_NOMAD(nomad_url, token, upload_file):
-    '''Upload a single file as a new NOMAD upload. Compressed zip/tar files are automatically decompressed.'''
-    with open(upload_file, 'rb') as f:
+def iter_file_chunks(file_obj, total_size=None, chunk_size=UPLOAD_CHUNK_SIZE, progress=None):
+    '''Generator of the chunks of an open binary file, calling progress(sent_bytes, total_size)
+    after each chunk. Used as request body, the file is sent with chunked transfer encoding.'''
+    sent = 0
+    while chunk := file_obj.read(chunk_size):
+        yield chunk
+        sent += len(chunk)
+        if progress:
+            progress(sent, total_size)
+
+def rewound_chunks(file_obj, total_size=None, chunk_size=UPLOAD_CHUNK_SIZE, progress=None):
+    '''Body factory for NomadClient.request: the chunks (see iter_file_chunks) of file_obj from its start.'''
+    def body():
+        file_obj.seek(0)
+        return iter_file_chunks(file_obj, total_size, chunk_size, progress)
+    return body
+
+def print_progress(sent, total):
+    '''Simple progress callback for the uploads (total is None for streamed zips).'''
+    if total:
+        print(f"\rUploaded {sent / 1e6:.1f}/{total / 1e6:.1f} MB ({100 * sent / total:.0f}%)", end='' if sent < total else '\n')
+    else:
+        print(f"\rUploaded {sent / 1e6:.1f} MB", end='')
+
+class ZipStream(io.RawIOBase):
+    '''Unseekable sink of a ZipFile: the written bytes are collected until taken by iter_zip_chunks.'''
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+
+    def take(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+def iter_zip_chunks(archives, chunk_size=UPLOAD_CHUNK_SIZE):
+    '''
+    Generator of the bytes of a zip of the (mainfile, data) archives, in chunks of about chunk_size bytes.
+    The zip is compressed while it is consumed (e.g. as request body, so compression and network transfer
+    overlap) and never stored as a whole.
+    '''
+    import zipfile
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for mainfile, data in archives:
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            with zf.open(mainfile, 'w') as member:
+                for start in range(0, len(data), chunk_size):
+                    member.write(data[start:start + chunk_size])
+                    if len(stream.buffer) >= chunk_size:
+                        yield stream.take()
+            if len(stream.buffer) >= chunk_size:
+                yield stream.take()
+    yield stream.take()  # the central directory, written when the zip is closed
+
+def iter_counted(chunks, progress=None, sent=None):
+    '''Pass the chunks through, counting the bytes in sent['size'] and calling progress(sent_bytes, None).'''
+    size = 0
+    for chunk in chunks:
+        yield chunk
+        size += len(chunk)
+        if sent is not None:
+            sent['size'] = size
+        if progress:
+            progress(size, None)
+
+def fileobj_size(file_obj):
+    '''Size of a seekable file object, which is left at its start.'''
+    file_obj.seek(0, os.SEEK_END)
+    size = file_obj.tell()
+    file_obj.seek(0)
+    return size
+
+def upload_to_NOMAD(nomad_url, token, upload_file, progress=None, chunk_size=UPLOAD_CHUNK_SIZE, chunk_timeout=UPLOAD_CHUNK_TIMEOUT,
+                    file_name=None):
+    '''Upload a single file as a new NOMAD upload. Compressed zip/tar files are automatically decompressed.
+    upload_file is a path, an open binary file object (e.g. an in-memory zip), a function returning an
+    iterable of bytes chunks (e.g. lambda: iter_zip_chunks(archives), called again if the upload has to be
+    resent after a token refresh) or an iterable of chunks, sent only once; for all but the path file_name is needed.
+    The file is streamed in chunks: progress(sent_bytes, total_bytes) is called after each
+    chunk and the upload fails only if a single chunk takes more than chunk_timeout seconds.'''
+    sent = {}
+    if hasattr(upload_file, 'read'):
+        opened, size = nullcontext(upload_file), fileobj_size(upload_file)
+    elif isinstance(upload_file, (str, os.PathLike)):
+        opened, size = open(upload_file, 'rb'), os.path.getsize(upload_file)
+        file_name = file_name or os.path.basename(upload_file)
+    else:
+        opened, size = nullcontext(None), None
+    with opened as f:
+        if f is not None:
+            body = {'body': rewound_chunks(f, size, chunk_size, progress)}
+        elif callable(upload_file):
+            body = {'body': lambda: iter_counted(upload_file(), progress, sent)}
+        else:
+            body = {'data': iter_counted(upload_file, progress, sent)}
         try:
-            response = requests.post(
-                f'{nomad_url}uploads?file_name={os.path.basename(upload_file)}',
-                headers={'Authorization': f'Bearer {token}', 'Accept': 'application/json'},
-                data=f,
-                timeout=30
+            start_time = time.time()
+            response = get_client(nomad_url, token).post(
+                'uploads',
+                params={'file_name': file_name},
+                token=token,
+                timeout=(10, chunk_timeout),  # (connect, each socket operation)
+                **body
             )
             response.raise_for_status()  # Explicitly check HTTP status code
 
             upload_id = response.json().get('upload_id')
             if upload_id:
+                get_client(nomad_url).record_upload(
+                    upload_id, size=size if size is not None else sent.get('size', 0), started=start_time,
+                    upload_time=time.time() - start_time)
                 return upload_id, True  # Return a success flag
 
             print('Response is missing upload_id:', response.json())
@@ -144,9 +470,9 @@ def check_upload_status(nomad_url, token, upload_id):
     Returns the status message if successful, otherwise returns None.
     '''
     try:
-        response = requests.get(
-            f'{nomad_url}uploads/{upload_id}',
-            headers={'Authorization': f'Bearer {token}'},
+        response = get_client(nomad_url, token).get(
+            f'uploads/{upload_id}',
+            token=token,
             timeout=30
         )
         response.raise_for_status()  # Check if the request was successful
@@ -197,36 +523,58 @@ def check_upload_status(nomad_url, token, upload_id):
 
 #         time.sleep(interval)
 
-@delayed_call(delay_seconds=2)  # waits 2 seconds before execution  
-def wait_for_upload_completion(nomad_url, token, upload_id, interval=5, timeout=50):
+def poll_intervals(first=POLL_FIRST_INTERVAL, maximum=POLL_MAX_INTERVAL, backoff=POLL_BACKOFF, jitter=POLL_JITTER):
+    '''Endless generator of polling intervals: exponential backoff with random jitter.'''
+    interval = first
+    while True:
+        yield interval * random.uniform(1 - jitter, 1 + jitter)
+        interval = min(interval * backoff, maximum)
+
+def upload_timeout(upload_size=0):
+    '''Processing timeout [s] for an upload of upload_size bytes.'''
+    return POLL_BASE_TIMEOUT + POLL_TIMEOUT_PER_MB * upload_size / 1e6
+
+def wait_for_upload_completion(nomad_url, token, upload_id, interval=POLL_MAX_INTERVAL, timeout=None, upload_size=None):
     '''
-    Waits for NOMAD upload to complete by polling every 'interval' seconds,
-    until 'timeout' seconds have passed.
+    Waits for NOMAD upload to complete by polling with an adaptive interval: the first
+    poll comes after POLL_FIRST_INTERVAL seconds, then the interval grows up to
+    'interval' seconds (see poll_intervals). It gives up after 'timeout' seconds,
+    by default scaled with the size of the upload (see upload_timeout).
 
     Returns the final status message if successful, or returns None if it fails.
     '''
+    client = get_client(nomad_url)
+    if upload_size is None:
+        upload_size = client.upload_stats.get(upload_id, {}).get('size', 0)
+    if timeout is None:
+        timeout = upload_timeout(upload_size)
+
     start_time = time.time()
-    while True:
-        # Check if the timeout is reached
-        if time.time() - start_time > timeout:
+    polls = 0
+    for sleep_time in poll_intervals(maximum=interval):
+        # Check if the timeout is reached, without sleeping past it
+        remaining = timeout - (time.time() - start_time)
+        if remaining <= 0:
             print("Timeout reached before upload completion.")
+            client.record_upload(upload_id, processing_time=time.time() - start_time, polls=polls, timed_out=True)
             return None
+        time.sleep(min(sleep_time, remaining))
 
         # Checking upload status
         status_message, success = check_upload_status(nomad_url, token, upload_id)
+        polls += 1
 
         if not success:
             print("Failed to retrieve upload status. Retrying...")
-            time.sleep(interval)
             continue  # Retry instead of raising an exception
 
         if status_message == 'Process process_upload completed successfully':
             print('Upload completed successfully!')
+            client.record_upload(upload_id, processing_time=time.time() - start_time, polls=polls)
             return status_message  # Successfully completed
 
         # Still processing, keep waiting
         print(f"Current status: {status_message}. Waiting...")
-        time.sleep(interval)
 
 # def get_upload_entries(nomad_url, token, upload_id):
 #     """
@@ -266,31 +614,25 @@ def wait_for_upload_completion(nomad_url, token, upload_id, interval=5, timeout=
 #         print(f"Request error occurred: {err}")
 #         raise
 
-# import requests
-import requests
-
-def get_upload_entries(nomad_url, token, upload_id):
+def get_upload_entries(nomad_url, token, upload_id, page=1, page_size=ENTRIES_PAGE_SIZE):
     """
-    Fetch entries for a given NOMAD upload ID.
+    Fetch one page of entries for a given NOMAD upload ID (see iter_upload_entries for all of them).
 
     Args:
         nomad_url (str): Base URL of the NOMAD API.
         token (str): Bearer authentication token.
         upload_id (str): Upload ID to fetch entries for.
+        page (int): Page to fetch, starting from 1.
+        page_size (int): Number of entries per page.
 
     Returns:
         tuple: (data, success) where:
             - data (dict or None): JSON data of the response if successful.
             - success (bool): True if successful, False otherwise.
     """
-    url = f"{nomad_url}uploads/{upload_id}/entries"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Accept": "application/json"
-    }
-
     try:
-        response = requests.get(url, headers=headers, timeout=30)
+        response = get_client(nomad_url, token).get(
+            f"uploads/{upload_id}/entries", params={'page': page, 'page_size': page_size}, token=token, timeout=30)
         response.raise_for_status()  # Check for HTTP errors
 
         data = response.json()
@@ -313,6 +655,46 @@ def get_upload_entries(nomad_url, token, upload_id):
         print(f"Unexpected error fetching upload entries: {e}")
         return None, False
 
+def iter_upload_entries(nomad_url, token, upload_id, page_size=ENTRIES_PAGE_SIZE, workers=ENTRIES_PAGE_WORKERS, first_page=None):
+    """
+    Yield the (mainfile, entry_id) pairs of all the entries of an upload, following the pagination.
+    After the first page (which can be passed as first_page if already fetched, with the same
+    page_size) the following pages are fetched concurrently over the pooled client, with at most
+    `workers` pages in flight, and yielded in order as they arrive.
+
+    Raises:
+        requests.RequestException: If a page cannot be fetched.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from collections import deque
+
+    def fetch(page):
+        response = get_client(nomad_url, token).get(
+            f"uploads/{upload_id}/entries", params={'page': page, 'page_size': page_size}, token=token, timeout=30)
+        response.raise_for_status()
+        return response.json()
+
+    def pairs(data):
+        for entry in data.get('data', []):
+            if entry.get('entry_id') and entry.get('mainfile'):
+                yield entry['mainfile'], entry['entry_id']
+
+    data = first_page if first_page is not None else fetch(1)
+    yield from pairs(data)
+    total = data.get('pagination', {}).get('total', len(data.get('data', [])))
+    n_pages = -(-total // page_size)
+    if n_pages <= 1:
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        next_page = 2
+        while pending or next_page <= n_pages:
+            while next_page <= n_pages and len(pending) < workers:
+                pending.append(pool.submit(fetch, next_page))
+                next_page += 1
+            yield from pairs(pending.popleft().result())
+
 # def delete_upload(nomad_url, token, upload_id):
 #     """
 #     Delete a NOMAD upload given its ID.
@@ -365,14 +747,8 @@ def delete_upload(nomad_url, token, upload_id):
             - data (dict or None): JSON data of the response if successful.
             - success (bool): True if successful, False otherwise.
     """
-    url = f"{nomad_url}uploads/{upload_id}"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Accept": "application/json"
-    }
-
     try:
-        response = requests.delete(url, headers=headers, timeout=30)
+        response = get_client(nomad_url, token).delete(f"uploads/{upload_id}", token=token, timeout=30)
         response.raise_for_status()  # Check for HTTP errors
 
         data = response.json()
@@ -392,58 +768,307 @@ def delete_upload(nomad_url, token, upload_id):
         return None, False
 
 
-def upload_file(file_path = 'nomuploads/PicoTCDv3/PicoTCDv3_steps.zip', autodelete = False):
-    nomad_url = 'http://192.168.157.46:8000/fairdi/nomad/latest/api/v1/'
+def split_zip(zip_path, part_size=RESUMABLE_PART_SIZE, parts_dir=None):
+    '''
+    Split a zip file into smaller zip files of about part_size bytes each (a member is
+    never split). Members keep their name, date and compression method.
+    Returns the list of the part paths (in parts_dir, by default next to zip_path).
+    '''
+    import zipfile
+    zip_path = Path(zip_path)
+    parts_dir = Path(parts_dir) if parts_dir else zip_path.with_name(zip_path.stem + '_parts')
+    parts_dir.mkdir(parents=True, exist_ok=True)
+
+    parts, current, current_size = [], None, 0
+    with zipfile.ZipFile(zip_path) as src:
+        for info in src.infolist():
+            if current is None or (current_size and current_size + info.compress_size > part_size):
+                if current is not None:
+                    current.close()
+                part_path = parts_dir / f"{zip_path.stem}_part{len(parts):03d}.zip"
+                parts.append(part_path)
+                current, current_size = zipfile.ZipFile(part_path, 'w'), 0
+            with src.open(info) as member, current.open(info, 'w') as dest:
+                shutil.copyfileobj(member, dest, UPLOAD_CHUNK_SIZE)
+            current_size += info.compress_size
+    if current is not None:
+        current.close()
+    return parts
+
+def create_upload(nomad_url, token, upload_name=None):
+    '''Create an empty NOMAD upload, return (upload_id, success).'''
+    try:
+        response = get_client(nomad_url, token).post(
+            'uploads', params={'upload_name': upload_name} if upload_name else None, token=token, timeout=30)
+        response.raise_for_status()
+        return response.json()['upload_id'], True
+    except (requests.RequestException, KeyError, ValueError) as e:
+        print(f"Error creating an empty upload: {e}")
+        return None, False
+
+def put_upload_file(nomad_url, token, upload_id, file_path, progress=None, chunk_timeout=UPLOAD_CHUNK_TIMEOUT):
+    '''Stream file_path into the raw folder of an existing upload (zip files are extracted).'''
+    with open(file_path, 'rb') as f:
+        try:
+            response = get_client(nomad_url, token).request(
+                'PUT', f'uploads/{upload_id}/raw/',
+                params={'file_name': os.path.basename(file_path)}, token=token,
+                body=rewound_chunks(f, os.path.getsize(file_path), progress=progress),
+                timeout=(10, chunk_timeout))
+            response.raise_for_status()
+            return True
+        except requests.RequestException as e:
+            print(f"Error uploading {file_path} to upload {upload_id}: {e}")
+            return False
+
+def upload_resumable(nomad_url, token, zip_path, part_size=RESUMABLE_PART_SIZE, progress=None, retries=3):
+    '''
+    Upload a large zip file in parts: the zip is split (see split_zip), an empty upload is
+    created and each part is streamed into it, waiting for its processing before the next one.
+    Completed parts are recorded in <zip_path>.upload_state.json: if the upload is interrupted,
+    calling this function again resumes it from the first missing part (as long as the zip
+    is unchanged). Each part is retried up to `retries` times.
+    This is a standalone tool for existing zip files on disk (upload_file of a path): the FAIR
+    export streams its archives in a single request (upload_archives) and never goes through it.
+    Returns (upload_id, success).
+    '''
+    zip_path = Path(zip_path)
+    state_file = zip_path.with_name(zip_path.name + '.upload_state.json')
+    signature = {'size': zip_path.stat().st_size, 'mtime': zip_path.stat().st_mtime, 'part_size': part_size}
+
+    state = json.loads(state_file.read_text()) if state_file.exists() else {}
+    if state.get('signature') != signature:
+        state = {'signature': signature, 'upload_id': None, 'done': []}
+
+    start_time = time.time()
+    parts = split_zip(zip_path, part_size)
+    if state['upload_id'] is None:
+        state['upload_id'], success = create_upload(nomad_url, token, zip_path.name)
+        if not success:
+            return None, False
+        state_file.write_text(json.dumps(state))
+    upload_id = state['upload_id']
+
+    sent_before = sum(p.stat().st_size for p in parts if p.name in state['done'])
+    for part in parts:
+        if part.name in state['done']:
+            print(f"Part {part.name} already uploaded, skipping.")
+            continue
+        part_progress = (lambda sent, total, base=sent_before: progress(base + sent, signature['size'])) if progress else None
+        for attempt in range(retries):
+            if put_upload_file(nomad_url, token, upload_id, part, part_progress) and \
+                    wait_for_upload_completion(nomad_url, token, upload_id, upload_size=part.stat().st_size):
+                break
+            print(f"Part {part.name} failed (attempt {attempt + 1}/{retries}).")
+        else:
+            print(f"Giving up: call upload_resumable again to resume upload {upload_id}.")
+            return upload_id, False
+        state['done'].append(part.name)
+        state_file.write_text(json.dumps(state))
+        sent_before += part.stat().st_size
+
+    shutil.rmtree(parts[0].parent, ignore_errors=True)
+    state_file.unlink()
+    get_client(nomad_url).record_upload(upload_id, size=signature['size'], started=start_time,
+                                        upload_time=time.time() - start_time, parts=len(parts))
+    return upload_id, True
+
+def upload_file(file_path = 'nomuploads/PicoTCDv3/PicoTCDv3_steps.zip', autodelete = False, progress=None, nomad_url=None,
+                file_name=None, lazy_entries=False):
+    '''Upload -> wait for processing -> fetch entries. file_path can also be an open binary file object
+    or chunks of bytes (see upload_to_NOMAD and iter_zip_chunks), named file_name.
+    The whole listing of the entries is read in a dict, unless lazy_entries: then the entries are
+    an iterator of (mainfile, entry_id) pairs, whose pages are fetched while it is consumed (see
+    iter_upload_entries, it raises requests.RequestException if a page cannot be fetched).
+    Returns {upload_id: {mainfile: entry_id}}, False if some entries failed processing on NOMAD
+    (uploading the same files again does not help), None if something else went wrong.'''
+    nomad_url = nomad_url or NOMAD_URL
 
     print('getting authentication token...')
-    token, success = get_authentication_token(nomad_url)
-    if not success:
+    token = get_client(nomad_url).get_token()  # cached, shared by all the uploads
+    if token is None:
         print("Failed to get authentication token. Aborting upload.")
         return None
 
     print('starting upload...')
-    upload_id, success = upload_to_NOMAD(nomad_url, token, file_path)
+    on_disk = isinstance(file_path, (str, os.PathLike))
+    file_size = os.path.getsize(file_path) if on_disk else fileobj_size(file_path) if hasattr(file_path, 'read') else None
+    with span('upload', streamed=file_size is None) as sp:
+        if on_disk and file_size > RESUMABLE_PART_SIZE and str(file_path).endswith('.zip'):
+            upload_id, success = upload_resumable(nomad_url, token, file_path, progress=progress)
+        else:
+            upload_id, success = upload_to_NOMAD(nomad_url, token, file_path, progress=progress, file_name=file_name)
+        if success and file_size is None:  # streamed, known only now
+            file_size = get_client(nomad_url).upload_stats[upload_id]['size']
+        sp['bytes'] = file_size
     if not success:
         print("Failed to upload to NOMAD. Aborting.")
         return None
     print(f'UPLOAD ID: {upload_id}')
 
-    last_status_message = wait_for_upload_completion(nomad_url, token, upload_id)
+    with span('wait') as sp:
+        last_status_message = wait_for_upload_completion(nomad_url, token, upload_id, upload_size=file_size)
+        sp['polls'] = get_client(nomad_url).upload_stats[upload_id].get('polls', 0)
     if last_status_message is None:
         print("Upload process did not complete successfully. Aborting.")
         return None
     print(last_status_message)
 
-    data, success = get_upload_entries(nomad_url, token, upload_id)
-    if not success or data is None:
-        print("Failed to fetch entries. Aborting.")
-        return None
-    print(f"Entry processing failed: {(fails := data['processing_failed'])}")
-    # If there are no failures, proceed to fetch entries
+    with span('entries') as sp:
+        data, success = get_upload_entries(nomad_url, token, upload_id)
+        if not success or data is None:
+            print("Failed to fetch entries. Aborting.")
+            return None
+        print(f"Entry processing failed: {(fails := data['processing_failed'])}")
+        sp['failed'] = fails
+        # If there are no failures, proceed to fetch entries
+        if fails == 0 and lazy_entries:
+            my_entries = {upload_id: iter_upload_entries(nomad_url, token, upload_id, first_page=data)}
+        elif fails == 0:
+            print('Fetching entries...')
+            try:
+                my_entries = {upload_id: dict(iter_upload_entries(nomad_url, token, upload_id, first_page=data))}
+            except requests.RequestException as e:
+                print(f"Failed to fetch all the entries: {e}. Aborting.")
+                return None
+            sp['entries'] = len(my_entries[upload_id])
     if fails == 0:
-        print('Fetching entries...')
-        my_entries = {}
-        for entry in data.get('data', []):
-            entry_id = entry.get('entry_id')
-            filename = entry.get('mainfile')
-            if entry_id and filename:
-                my_entries[filename] = entry_id
-        my_entries = {upload_id: my_entries}
-
+        client = get_client(nomad_url)
+        client.record_upload(upload_id, total_time=time.time() - client.upload_stats[upload_id]['started'])
+        print(f"Upload {upload_id} latency: {client.upload_stats[upload_id]}")
         return my_entries  # Successfully fetched entries
 
-    # Something went wrong with processing, return None
+    # Something went wrong with processing, return False
     # If autodelete is enabled, attempt to delete the upload
     if autodelete:
         print('Deleting upload due to processing failures...')
         del_log, success = delete_upload(nomad_url, token, upload_id)
         if not success:
             print("Failed to delete the upload. Check the server logs.")
-    return None
+    return False
+
+def dump_archive(data, compact=False):
+    '''Serialize an archive dict: indented as usual, or compact (no whitespace, faster C encoder).'''
+    if compact:
+        return json.dumps(data, separators=(',', ':'))
+    return json.dumps(data, indent=4)
+
+_serialize_pools = {}
+_serialize_pools_lock = threading.Lock()
+
+def get_serialize_pool(workers):
+    '''Process pool of `workers` processes for serialize_archives, started on first use and kept.'''
+    with _serialize_pools_lock:
+        if workers not in _serialize_pools:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            _serialize_pools[workers] = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+        return _serialize_pools[workers]
+
+def serialize_archives(archive_dicts, compact=False, workers=None):
+    '''
+    Serialize a list of archive dicts (see dump_archive) and return the list of strings.
+    At least SERIALIZE_PARALLEL_MIN indented archives are split among `workers` processes
+    (default SERIALIZE_WORKERS, 1 to serialize them here).
+    '''
+    workers = SERIALIZE_WORKERS if workers is None else workers
+    if compact or workers < 2 or len(archive_dicts) < SERIALIZE_PARALLEL_MIN:
+        return [dump_archive(data, compact) for data in archive_dicts]
+    return list(get_serialize_pool(workers).map(dump_archive, archive_dicts,
+                                                chunksize=max(1, len(archive_dicts) // (4 * workers))))
+
+def build_zip(archives, spool_size=ARCHIVE_SPOOL_SIZE):
+    '''
+    Zip the (mainfile, data) archives into a temporary file kept in memory up to spool_size bytes
+    (then moved to disk). Returns the file object, at its start.
+    '''
+    import zipfile
+    import tempfile
+    zip_obj = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    with zipfile.ZipFile(zip_obj, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for mainfile, data in archives:
+            zf.writestr(mainfile, data)
+    zip_obj.seek(0)
+    return zip_obj
+
+def find_uploaded_archives(archives, index, nomad_url=None):
+    """
+    Hash the archives and look them up in the index (see archive_index.ArchiveIndex).
+
+    Args:
+        archives (list): (mainfile, data) pairs, data being the content (str or bytes) of the archive.
+
+    Returns:
+        tuple: (known, hashes) where:
+            - known (dict): mainfile -> (upload_id, entry_id) of the archives already uploaded.
+            - hashes (dict): mainfile -> content hash of all the archives.
+    """
+    from archive_index import content_hash
+    nomad_url = nomad_url or NOMAD_URL
+    known, hashes = {}, {}
+    for mainfile, data in archives:
+        hashes[mainfile] = content_hash(data)
+        if index is not None and (entry := index.get(nomad_url, hashes[mainfile])):
+            known[mainfile] = entry
+    return known, hashes
+
+def upload_archives(archives, zip_name, index=None, autodelete=False, progress=None, nomad_url=None, stream=True):
+    """
+    Zip and upload only the archives whose content is not in the index yet, and record
+    them in it. If nothing changed, nothing is uploaded. With stream=True the zip is produced while it
+    is sent (iter_zip_chunks), otherwise it is built first in a spooled temporary file (build_zip).
+
+    Args:
+        archives (list): (mainfile, data) pairs: path of the archive in the upload and its content.
+        zip_name (str): File name of the uploaded zip.
+        index (ArchiveIndex): Index of the uploaded archives, None to upload everything.
+
+    Returns:
+        tuple: (references, success) where:
+            - references (dict, None or False): mainfile -> (upload_id, entry_id) of all the archives,
+              in the order of archives; False if some entries failed processing (see upload_file).
+            - success (bool): True if successful, False otherwise.
+    """
+    nomad_url = nomad_url or NOMAD_URL
+    known, hashes = find_uploaded_archives(archives, index, nomad_url)
+    changed = [(mainfile, data) for mainfile, data in archives if mainfile not in known]
+    print(f"{len(known)} archives unchanged, {len(changed)} to upload.")
+
+    references = dict(known)
+    if changed:
+        if stream:  # zipped while uploading, the zip time is in the upload span
+            entry_dict = upload_file(lambda: iter_zip_chunks(changed), autodelete, progress, nomad_url,
+                                     file_name=zip_name, lazy_entries=True)
+        else:
+            with span('zip', archives=len(changed)) as sp:
+                zip_obj = build_zip(changed)
+                sp['bytes'] = fileobj_size(zip_obj)
+            with zip_obj:
+                entry_dict = upload_file(zip_obj, autodelete, progress, nomad_url, file_name=zip_name, lazy_entries=True)
+        if not entry_dict:
+            return entry_dict, False
+        (upload_id, entries), = entry_dict.items()
+        uploaded = {mainfile for mainfile, _ in changed}
+        try:
+            with span('listing') as sp:
+                for mainfile, entry_id in entries:  # page by page, only the references are kept
+                    if mainfile in uploaded:
+                        references[mainfile] = (upload_id, entry_id)
+                        if index is not None:
+                            index.add(nomad_url, hashes[mainfile], upload_id, entry_id, mainfile)
+                sp['entries'] = len(references) - len(known)
+        except requests.RequestException as e:
+            print(f"Failed to fetch all the entries of upload {upload_id}: {e}.")
+            return None, False
+        for mainfile, _ in changed:
+            if mainfile not in references:
+                print(f"No entry for {mainfile} in upload {upload_id}.")
+                return None, False
+    return {mainfile: references[mainfile] for mainfile in hashes}, True
 
 if __name__ == '__main__': 
     # if upload_steps succeded, go on with other publish, else exit the function
-    if (upload_dict:=upload_file()) is None:
+    if not (upload_dict:=upload_file()):
         print('Some entries have bugs.\n')
         #return
     # write the json dict in a file in the process_path with pathlib,
@@ -0,0 +1,271 @@
+"""
+Asyncio version of the NOMAD client of API_collection.py.
+
+Same operations as coroutines (authentication, upload, status check, wait for
+completion, entries, delete), plus upload_many, which runs many
+upload -> wait -> fetch-entries pipelines concurrently and yields the results
+as each one completes:
+
+    async def main(paths):
+        async with AsyncNomadClient() as client:
+            async for path, entries in client.upload_many(paths, limit=8):
+                print(path, entries)
+
+    asyncio.run(main(paths))
+
+Requires aiohttp.
+"""
+import os
+import time
+import asyncio
+
+import aiohttp
+
+from API_collection import (NOMAD_URL, POLL_MAX_INTERVAL, TOKEN_REFRESH_MARGIN, TOKEN_DEFAULT_LIFETIME,
+                            ENTRIES_PAGE_SIZE, ENTRIES_PAGE_WORKERS, poll_intervals, upload_timeout, token_expiry,
+                            normalize_url)
+
+# errors of a request that fail a single upload pipeline: HTTP and connection errors, timeouts
+# and invalid (e.g. non-JSON) responses
+REQUEST_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, ValueError)
+
+
+class AsyncNomadClient:
+    """
+    Asyncio NOMAD client with a pooled keep-alive aiohttp session.
+
+    Args:
+        nomad_url (str): Base URL of the NOMAD API.
+        limit (int): Max number of concurrent connections of the session.
+        retries (int): Retry budget for transient failures (connection errors, 429, 5xx)
+            of idempotent requests, with exponential backoff (backoff_factor * 2**n seconds).
+            The other requests (POST) are retried only when the server refused them (429, 503).
+        timeout (float): Default timeout of each request [s].
+    """
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+    REFUSED_STATUS = (429, 503)
+
+    def __init__(self, nomad_url=NOMAD_URL, limit=10, retries=3, backoff_factor=0.5, timeout=30):
+        self.nomad_url = normalize_url(nomad_url)
+        self.limit = limit
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.session = None
+        self.token = None
+        self.expires_at = 0
+        self._token_lock = None
+        # upload_id -> observed latencies, as NomadClient.upload_stats
+        self.upload_stats = {}
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def open(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit),
+                headers={'Accept': 'application/json'})
+            self._token_lock = asyncio.Lock()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def request(self, method, path, retry=True, auth=True, body=None, **kwargs):
+        """Send a request and return (status, json). Idempotent requests are retried
+        on transient failures, the others (retry=False) only on REFUSED_STATUS, and every request is retried once after a 401 (an attempt
+        that does not count in the retry budget). body is a function returning the request
+        data, called at every attempt (aiohttp closes the file objects it has sent)."""
+        await self.open()
+        kwargs.setdefault('timeout', aiohttp.ClientTimeout(total=self.timeout))
+        attempts = self.retries + 1
+        retry_status = self.RETRY_STATUS if retry else self.REFUSED_STATUS
+        refreshed = False
+        extra_headers = kwargs.pop('headers', {})
+        attempt = -1
+        while (attempt := attempt + 1) < attempts:
+            headers = dict(extra_headers)
+            if body is not None:
+                kwargs['data'] = body()
+            if auth:
+                headers['Authorization'] = f'Bearer {await self.get_token()}'
+            try:
+                async with self.session.request(method, self.nomad_url + path, headers=headers, **kwargs) as response:
+                    if response.status == 401 and auth and not refreshed:
+                        refreshed = True
+                        attempts += 1
+                        await self.refresh_token(headers['Authorization'][len('Bearer '):])
+                        continue
+                    if response.status in retry_status and attempt < attempts - 1:
+                        await asyncio.sleep(self.backoff_factor * 2 ** attempt)
+                        continue
+                    response.raise_for_status()
+                    return response.status, await response.json(content_type=None)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if not retry or attempt == attempts - 1:
+                    raise
+                await asyncio.sleep(self.backoff_factor * 2 ** attempt)
+        raise aiohttp.ClientError(f'{method} {path}: retry budget exhausted')
+
+    # ---------------    AUTHENTICATION    ---------------
+    async def _fetch_token(self):
+        _, data = await self.request(
+            'GET', 'auth/token', auth=False,
+            params=dict(username=os.environ.get('NOMAD_USERNAME', ''), password=os.environ.get('NOMAD_PASSWORD', '')))
+        self.token = data.get('access_token')
+        if not self.token:
+            raise aiohttp.ClientError(f'Response is missing token: {data}')
+        self.expires_at = token_expiry(self.token) or time.time() + TOKEN_DEFAULT_LIFETIME
+        return self.token
+
+    async def get_token(self):
+        """Cached token, shared by all the concurrent pipelines."""
+        async with self._token_lock:
+            if self.token is None or time.time() > self.expires_at - TOKEN_REFRESH_MARGIN:
+                await self._fetch_token()
+            return self.token
+
+    async def refresh_token(self, stale_token=None):
+        async with self._token_lock:
+            if self.token is None or self.token == stale_token:
+                await self._fetch_token()
+            return self.token
+
+    # ---------------    UPLOAD OPERATIONS    ---------------
+    async def upload_to_NOMAD(self, upload_file):
+        """Upload a single file as a new NOMAD upload, return its upload_id."""
+        start_time = time.time()
+        _, data = await self.request(
+            'POST', 'uploads', retry=False, params={'file_name': os.path.basename(upload_file)},
+            body=lambda: open(upload_file, 'rb'), timeout=aiohttp.ClientTimeout(total=None, sock_read=self.timeout))
+        upload_id = data.get('upload_id')
+        if not upload_id:
+            raise aiohttp.ClientError(f'Response is missing upload_id: {data}')
+        self.upload_stats[upload_id] = {'size': os.path.getsize(upload_file), 'started': start_time,
+                                        'upload_time': time.time() - start_time}
+        return upload_id
+
+    async def check_upload_status(self, upload_id):
+        _, data = await self.request('GET', f'uploads/{upload_id}')
+        return data.get('data', {}).get('last_status_message')
+
+    async def wait_for_upload_completion(self, upload_id, interval=POLL_MAX_INTERVAL, timeout=None):
+        """Adaptive polling as API_collection.wait_for_upload_completion.
+        Returns the final status message, or None on timeout."""
+        stats = self.upload_stats.setdefault(upload_id, {})
+        if timeout is None:
+            timeout = upload_timeout(stats.get('size', 0))
+        start_time = time.time()
+        polls = 0
+        for sleep_time in poll_intervals(maximum=interval):
+            remaining = timeout - (time.time() - start_time)
+            if remaining <= 0:
+                stats.update(processing_time=time.time() - start_time, polls=polls, timed_out=True)
+                return None
+            await asyncio.sleep(min(sleep_time, remaining))
+            try:
+                status_message = await self.check_upload_status(upload_id)
+            except REQUEST_ERRORS as e:
+                print(f'Failed to retrieve status of upload {upload_id}: {e}. Retrying...')
+                continue
+            finally:
+                polls += 1
+            if status_message == 'Process process_upload completed successfully':
+                stats.update(processing_time=time.time() - start_time, polls=polls)
+                return status_message
+
+    async def get_upload_entries(self, upload_id, page=1, page_size=ENTRIES_PAGE_SIZE):
+        _, data = await self.request('GET', f'uploads/{upload_id}/entries',
+                                     params={'page': page, 'page_size': page_size})
+        return data
+
+    async def iter_upload_entries(self, upload_id, page_size=ENTRIES_PAGE_SIZE, workers=ENTRIES_PAGE_WORKERS,
+                                  first_page=None):
+        """Yield the (mainfile, entry_id) pairs of all the pages of entries, as
+        API_collection.iter_upload_entries: at most `workers` pages in flight, yielded in order."""
+        def pairs(data):
+            return [(entry['mainfile'], entry['entry_id'])
+                    for entry in data.get('data', []) if entry.get('entry_id') and entry.get('mainfile')]
+
+        data = first_page if first_page is not None else await self.get_upload_entries(upload_id, 1, page_size)
+        for pair in pairs(data):
+            yield pair
+        total = data.get('pagination', {}).get('total', len(data.get('data', [])))
+        n_pages = -(-total // page_size)
+        for start in range(2, n_pages + 1, workers):
+            pages = range(start, min(start + workers, n_pages + 1))
+            for data in await asyncio.gather(*(self.get_upload_entries(upload_id, p, page_size) for p in pages)):
+                for pair in pairs(data):
+                    yield pair
+
+    async def delete_upload(self, upload_id):
+        _, data = await self.request('DELETE', f'uploads/{upload_id}')
+        return data
+
+    async def upload_file(self, file_path, autodelete=False):
+        """Upload -> wait -> fetch entries pipeline. Returns {upload_id: {mainfile: entry_id}}
+        as API_collection.upload_file, or None if something went wrong (REQUEST_ERRORS are
+        caught here, so that a failed upload does not stop upload_many)."""
+        try:
+            upload_id = await self.upload_to_NOMAD(file_path)
+            if await self.wait_for_upload_completion(upload_id) is None:
+                print(f'Upload {upload_id} ({file_path}) did not complete before the timeout.')
+                return None
+            data = await self.get_upload_entries(upload_id)
+        except REQUEST_ERRORS as e:
+            print(f'Upload of {file_path} failed: {e}')
+            return None
+
+        if data.get('processing_failed', 0) == 0:
+            try:
+                entries = {mainfile: entry_id async for mainfile, entry_id
+                           in self.iter_upload_entries(upload_id, first_page=data)}
+            except REQUEST_ERRORS as e:
+                print(f'Failed to fetch the entries of upload {upload_id}: {e}')
+                return None
+            stats = self.upload_stats[upload_id]
+            stats['total_time'] = time.time() - stats['started']
+            return {upload_id: entries}
+
+        print(f"Upload {upload_id} ({file_path}): {data['processing_failed']} entries failed processing.")
+        if autodelete:
+            try:
+                await self.delete_upload(upload_id)
+            except REQUEST_ERRORS as e:
+                print(f'Failed to delete upload {upload_id}: {e}')
+        return None
+
+    async def upload_many(self, file_paths, limit=4, autodelete=False):
+        """Run the upload_file pipeline for all file_paths, at most `limit` at a time,
+        and yield (file_path, result) as each one completes."""
+        semaphore = asyncio.Semaphore(limit)
+
+        async def pipeline(path):
+            async with semaphore:
+                return path, await self.upload_file(path, autodelete=autodelete)
+
+        tasks = [asyncio.ensure_future(pipeline(path)) for path in file_paths]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+def upload_files(file_paths, nomad_url=NOMAD_URL, limit=4, autodelete=False):
+    """Blocking helper: upload all file_paths concurrently and return {file_path: result}."""
+    async def run():
+        results = {}
+        async with AsyncNomadClient(nomad_url, limit=max(limit, 1) * 2) as client:
+            async for path, result in client.upload_many(file_paths, limit=limit, autodelete=autodelete):
+                print(f'{path}: {"done" if result else "FAILED"}')
+                results[path] = result
+        return results
+    return asyncio.run(run())
@@ -1,50 +1,65 @@
 import datetime
 import platform
-from pprint import pprint
 from cams2nomad import cams2nomad
 import API_collection as api
+from upload_outbox import get_worker
+from archive_index import ArchiveIndex
+from cams_snapshot import CamsSnapshot, create_snapshot, steps_master
+from ids_ledger import get_ledger
 from pathlib import Path
 from jam.db.db_modules import SQLITE
 import json
 from datetime import datetime, date, timezone
 import shutil
+import threading
+from types import SimpleNamespace
+import time
+import tracing
 
-'''
-def copy_db(task):
-    task.copy_database(SQLITE, '/home/jampy/cams/cleanroom.sqlite')
-'''
-def update_ids_file(entry_dict: dict, file_path: Path):
-    """
-    Update the IDs.json file with new entry_dict data following the given schema.
-    If the file exists, it's updated; otherwise, it's created.
-    """
-    # Ensure the parent directory exists
-    file_path.parent.mkdir(parents=True, exist_ok=True)
-
-    # Load existing data from the file if it exists and is valid JSON
-    if file_path.exists():
-        try:
-            existing_data = json.loads(file_path.read_text(encoding="utf-8"))
-            if not isinstance(existing_data, dict):
-                existing_data = {}  # Reset if the file content is not a dictionary
-        except json.JSONDecodeError:
-            existing_data = {}  # Reset if the file content is invalid JSON
-    else:
-        existing_data = {}
-
-    # Extract the only key from entry_dict
-    first_key = next(iter(entry_dict))
+main_path = Path('static') / 'FAIR'
+# queue of the uploads, drained by OUTBOX_CONCURRENCY background threads of the server process
+OUTBOX_PATH = main_path / 'outbox.sqlite'
+OUTBOX_CONCURRENCY = 2
+# step_type plans (see get_step_type_plan), kept for the life of the server process
+_step_type_plans = {}
+_step_type_plans_lock = threading.Lock()
+# step fields that are not exported as parameters (the notes are merged in the "notes" field)
+EXCLUDE_LIST = ['note', 'comments']
+# worker processes serializing the step archives of large runs (None: API_collection.SERIALIZE_WORKERS,
+# 1: in the server process)
+ARCHIVE_WORKERS = None
+# content hash -> NOMAD entry of the archives already uploaded
+ARCHIVE_INDEX_PATH = main_path / 'archive_index.sqlite'
+# JSON lines of the timing spans of every export and upload, with a summary per run (see tracing.py)
+TRACE_PATH = main_path / 'trace.jsonl'
+# upload and entry IDs of the exported processes (see ids_ledger.py), it replaces the IDs.json of each process
+IDS_LEDGER_PATH = main_path / 'ids.jsonl'
+# read-only copy of the CAMS database for large exports (see copy_db)
+SNAPSHOT_PATH = main_path / 'cleanroom.sqlite'
 
-    # Prepare the new data structure
-    new_data = {"upload_steps_id": entry_dict[first_key]}
-    new_data.update(entry_dict)
+def copy_db(task, source_db=None):
+    """Snapshot of the CAMS database for the exports that should not load the live LIMS (see cams_snapshot.py):
+    bulk_upload_fair(CamsSnapshot(SNAPSHOT_PATH).load(start_date=...)). source_db: path of the live SQLite database."""
+    return create_snapshot(task, SNAPSHOT_PATH, source_db)
 
-    # Update the existing data with the new data
-    existing_data.update(new_data)
+class RecordedArchives:
+    """
+    Archive index (see api.upload_archives) that looks up the content hashes recorded in the IDs ledger for the
+    process first, then the global ArchiveIndex: unchanged steps are found even without the global index.
+    """
+    def __init__(self, recorded, index=None):
+        self.by_hash = {r["hash"]: (r["upload_id"], r["entry_id"]) for r in recorded.values()}
+        self.index = index
 
-    # Save the updated data back to the file
-    file_path.write_text(json.dumps(existing_data, indent=4), encoding="utf-8")
+    def get(self, nomad_url, content_hash):
+        if (entry := self.by_hash.get(content_hash)) is not None:
+            return entry
+        return self.index.get(nomad_url, content_hash) if self.index is not None else None
 
+    def add(self, nomad_url, content_hash, upload_id, entry_id, mainfile=None):
+        self.by_hash[content_hash] = (upload_id, entry_id)
+        if self.index is not None:
+            self.index.add(nomad_url, content_hash, upload_id, entry_id, mainfile)
 
 def serialize_value(value):
     if isinstance(value, (datetime,)):
@@ -108,62 +123,117 @@ def get_base_step_dict(step):
         "notes" : all_comments,
     }
      
-def enrich_step(item, s, step_data, exclude_list):
-    
-    print("Valore restituito da s.step_type.display_text:", s.step_type.display_text)
-
-    step_type = get_step_type(s, s.step_type.value)
-    step = s.task.item_by_ID(step_type).copy()
-    step.set_where(id=s.step_rec_id.value)
-    step.open()
+def get_step_types(item, step_type_ids):
+    """step_type id -> step_type (ID of the item with the step records), with one query"""
+    st = item.task.step_type.copy()
+    st.set_where(id__in=list(step_type_ids))
+    st.open()
+    return {st.id.value: st.step_type.value for _ in st}
 
+def get_field_orders(item, step_types):
+    """step_type -> field_order of catalogs.step_type (", "-joined field names), with one query"""
     st = item.task.catalogs.step_type.copy()
-    st.set_where(step_type=step_type)
+    st.set_where(step_type__in=list(step_types))
     st.open()
-    step_fieldlist = st.field_order.value.split(", ")[:-1]
-    print(step_fieldlist)
-    
-    """ OLD DICT WITH THE KEY EQUAL TO THE CAPTION, THE NEW ONE HAS THE KEY EQUAL TO THE VARIABLE
-    step_specific_info = {
-        field.field_caption: field.lookup_text if field.lookup_text else field.value
-        for field_name in step_fieldlist
-        if (field := step.field_by_name(field_name))
-        and not field.system_field()
-        and field.field_name not in exclude_list
-    }
-    pprint(step_specific_info)
-    print('\n\n')
+    field_orders = {}
+    for _ in st:
+        field_orders.setdefault(st.step_type.value, st.field_order.value)
+    return field_orders
+
+def get_step_type_plan(step, step_type, field_order, step_type_name, exclude_list):
     """
+    Cached reading plan of a step type, shared by all its steps and by all the exports of this server process:
+    the ordered field names to read (system fields and exclude_list already removed), the field with the
+    step notes and the cams2nomad entry of the step type.
+    The plan is rebuilt when the field_order of the catalog changes, see also invalidate_step_type_plans.
+    """
+    key = (step_type, tuple(exclude_list))
+    with _step_type_plans_lock:
+        plan = _step_type_plans.get(key)
+    if plan is None or plan["field_order"] != field_order or plan["name"] != step_type_name:
+        plan = {
+            "field_order": field_order,
+            "name": step_type_name,
+            "fields": [
+                field_name for field_name in field_order.split(", ")[:-1]
+                if (field := step.field_by_name(field_name))
+                and not field.system_field()
+                and field.field_name not in exclude_list
+            ],
+            "note_field": 'note' if step.field_by_name('note') else 'comments',
+            "cams2nomad": cams2nomad.get(step_type_name),
+        }
+        with _step_type_plans_lock:
+            _step_type_plans[key] = plan
+    return plan
+
+def invalidate_step_type_plans(step_type=None):
+    """Drop the cached plans of step_type (all of them if None), e.g. from the on_apply of catalogs.step_type."""
+    with _step_type_plans_lock:
+        for key in [key for key in _step_type_plans if step_type is None or key[0] == step_type]:
+            del _step_type_plans[key]
+
+def read_step_details(step, plan):
+    """(step_specific_info, step_note) of the current record of an open step dataset"""
     step_specific_info = {
         field_name: field.lookup_text if field.lookup_text else field.value
-        for field_name in step_fieldlist
+        for field_name in plan["fields"]
         if (field := step.field_by_name(field_name))
-        and not field.system_field()
-        and field.field_name not in exclude_list
     }
-    pprint(step_specific_info)
-    print("\n\n")
-    # put the 'note' or 'comment' field in the 'all_comments' var
-    field = x if (x := step.field_by_name('note')) else step.field_by_name('comments')
+    field = step.field_by_name(plan["note_field"])
     step_note = field.lookup_text if field.lookup_text else field.value
-    step_note = f"<ul> <li>Step notes</li> </ul> <p>{step_note}</p> "
-    step_data["notes"] = step_note + step_data["notes"]
+    return step_specific_info, step_note
+
+def prefetch_step_details(item, steps, exclude_list):
+    """
+    Read the specific parameters of all the steps of a run with one query per step type
+    (plus one for the step types and one for the catalog), instead of three queries per step.
+    steps is an open steps dataset, or a list of step records (e.g. the steps of many runs, see read_runs).
+    Returns {(step_type id, step_rec_id): (step_specific_info, step_note, plan)} for enrich_step.
+    """
+    keys, names = [], {}
+    for s in steps:
+        keys.append((s.step_type.value, s.step_rec_id.value))
+        names[s.step_type.value] = s.step_type.display_text
+    if not keys:
+        return {}
+    step_types = get_step_types(item, {type_id for type_id, _ in keys})
+    field_orders = get_field_orders(item, set(step_types.values()))
+    type_names = {step_types[type_id]: name for type_id, name in names.items() if type_id in step_types}
+
+    rec_ids = {}
+    for type_id, rec_id in keys:
+        if (step_type := step_types.get(type_id)) is not None:
+            rec_ids.setdefault(step_type, set()).add(rec_id)
+    details = {}
+    for step_type, ids in rec_ids.items():
+        step = item.task.item_by_ID(step_type).copy()
+        step.set_where(id__in=list(ids))
+        step.open()
+        plan = get_step_type_plan(step, step_type, field_orders.get(step_type, ""), type_names[step_type], exclude_list)
+        for _ in step:
+            details[(step_type, step.id.value)] = read_step_details(step, plan) + (plan,)
+    return {(type_id, rec_id): details[(step_types[type_id], rec_id)]
+            for type_id, rec_id in keys if (step_types.get(type_id), rec_id) in details}
+
+def enrich_step(item, s, step_data, exclude_list, prefetched=None):
+    """Add the specific parameters of the step, taken from prefetched (see prefetch_step_details)
+    if available, otherwise read from the database."""
+    if prefetched and (details := prefetched.get((s.step_type.value, s.step_rec_id.value))):
+        step_specific_info, step_note, plan = details
+        step_data["notes"] = f"<ul> <li>Step notes</li> </ul> <p>{step_note}</p> " + step_data["notes"]
+        step_data["m_def"] = (plan["cams2nomad"] or {}).get("m_def")  # unmapped types are skipped by transform_data
+        return step_data, step_specific_info
 
-    step_data["m_def"] = cams2nomad.get(s.step_type.display_text)["m_def"]
-    return step_data, step_specific_info
-    
-def enrich_step2(item, s, step_data, exclude_list):
     step_type = get_step_type(s, s.step_type.value)
     step = s.task.item_by_ID(step_type).copy()
     step.set_where(id=s.step_rec_id.value)
     step.open()
-    print(s.step_type.display_text)
-    print(step_type)
+
     st = item.task.catalogs.step_type.copy()
     st.set_where(step_type=step_type)
     st.open()
-    step_fieldlist = st.field_order.value.split(", ")[:-1]
-    print(step_fieldlist)
+    plan = get_step_type_plan(step, step_type, st.field_order.value, s.step_type.display_text, exclude_list)
     
     """ OLD DICT WITH THE KEY EQUAL TO THE CAPTION, THE NEW ONE HAS THE KEY EQUAL TO THE VARIABLE
     step_specific_info = {
@@ -176,158 +246,439 @@ def enrich_step2(item, s, step_data, exclude_list):
     pprint(step_specific_info)
     print('\n\n')
     """
-    step_specific_info = {
-        field_name: field.field_caption
-        for field_name in step_fieldlist
-        if (field := step.field_by_name(field_name))
-        and not field.system_field()
-        and field.field_name not in exclude_list
-    }
-    pprint(step_specific_info)
-    print('\n')
+    step_specific_info, step_note = read_step_details(step, plan)
     # put the 'note' or 'comment' field in the 'all_comments' var
-    field = x if (x := step.field_by_name('note')) else step.field_by_name('comments')
-    step_note = field.lookup_text if field.lookup_text else field.value
     step_note = f"<ul> <li>Step notes</li> </ul> <p>{step_note}</p> "
-    all_comments = step_note + step_data["notes"]
-    step_data["notes"] = all_comments
+    step_data["notes"] = step_note + step_data["notes"]
 
+    step_data["m_def"] = (plan["cams2nomad"] or {}).get("m_def")  # unmapped types are skipped by transform_data
     return step_data, step_specific_info
+    
+def compile_cams2nomad(table):
+    """
+    Compile the cams2nomad table into one plan per step type: the flat list, in mapping order,
+    of (nomad_key, source_key, transform) and the precomputed constants. A mapping with an empty
+    source never reads the step, so its value (transform(None), e.g. the constant dewetting_temperature,
+    or None) is computed here and stored in constants, with source_key None.
+    Problems in the table are reported once, when the module is imported.
+    """
+    plans = {}
+    for step_type, step_info in table.items():
+        step_mapping = step_info.get("mapping", {})
+        step_transforms = step_info.get("transformations", {})
+        for new_key in step_transforms:
+            if new_key not in step_mapping:
+                print(f"cams2nomad['{step_type}']: transformation of the unmapped key '{new_key}' is ignored")
+        constants, fields = {}, []
+        for new_key, old_key in step_mapping.items():
+            if new_key != new_key.strip():
+                print(f"cams2nomad['{step_type}']: NOMAD key {new_key!r} has leading/trailing spaces")
+            transform = step_transforms.get(new_key)
+            if transform is not None and not callable(transform):
+                print(f"cams2nomad['{step_type}']: transformation of '{new_key}' is not callable, ignored")
+                transform = None
+            if not old_key:
+                try:
+                    constants[new_key] = transform(None) if transform else None
+                    fields.append((new_key, None, None))
+                    continue
+                except Exception as e:
+                    print(f"cams2nomad['{step_type}']: '{new_key}' cannot be precomputed ({e}), applied per step")
+            fields.append((new_key, old_key, transform))
+        plans[step_type] = {"m_def": step_info.get("m_def"), "fields": fields, "constants": constants}
+    return plans
 
-def transform_data(s, step_data, step_specific_info):
-    # fetch the mapping for nomad names for this step type
-    step_info = cams2nomad.get(s.step_type.display_text)
-    if step_info is None:
-        return None
-    step_mapping = step_info["mapping"]
-    # fetch the transformations needed for the parameters in this step_type, if exist
-    step_transforms = step_info.get("transformations", {})
-
-    for new_key, old_key in step_mapping.items():
-        value = step_specific_info.get(old_key)
-        # If a transformation exists for this key, apply it.
-        if new_key in step_transforms:
-            step_data[new_key] = step_transforms[new_key](value)
+# compiled once, at import
+TRANSFORM_PLANS = compile_cams2nomad(cams2nomad)
+_unmapped_step_types = set()
+
+def get_transform_plan(step_type_name):
+    """Compiled plan of the step type, None (reported once) if it is not mapped in cams2nomad."""
+    plan = TRANSFORM_PLANS.get(step_type_name)
+    if plan is None and step_type_name not in _unmapped_step_types:
+        _unmapped_step_types.add(step_type_name)
+        print(f"Step type '{step_type_name}' is not mapped in cams2nomad, its steps are skipped.")
+    return plan
+
+def apply_transform_plan(plan, step_data, step_specific_info):
+    constants = plan["constants"]
+    for new_key, old_key, transform in plan["fields"]:
+        if old_key is None:
+            step_data[new_key] = constants[new_key]
+        elif transform is not None:
+            step_data[new_key] = transform(step_specific_info.get(old_key))
         else:
-            # Otherwise, just assign the fetched value.
-            step_data[new_key] = value
-    
+            step_data[new_key] = step_specific_info.get(old_key)
     return step_data
 
-def upload_fair(item, run_id):
-    print(f"Uploading FAIR data for run_id: {run_id}")
-    upload = True
-    main_path = Path('static') / 'FAIR'
-    main_path.mkdir(parents=True, exist_ok=True)
-    success_path = main_path / 'SUCCCESS'
-    success_path.mkdir(parents=True, exist_ok=True)
+def transform_data(s, step_data, step_specific_info):
+    # fetch the compiled mapping for nomad names for this step type
+    plan = get_transform_plan(s.step_type.display_text)
+    if plan is None:
+        return None
+    return apply_transform_plan(plan, step_data, step_specific_info)
+
+def transform_steps(step_type_name, steps_data):
+    """Batch transform_data: steps_data is a list of (step_data, step_specific_info) of steps of the same type.
+    Returns the list of transformed step_data (all None if the step type is not mapped)."""
+    plan = get_transform_plan(step_type_name)
+    if plan is None:
+        return [None] * len(steps_data)
+    return [apply_transform_plan(plan, step_data, step_specific_info) for step_data, step_specific_info in steps_data]
+
+def upload_fair(item, run_id, single_upload=False, background=True, compact=False, write_files=True, incremental=False):
+    """
+    Export the run to NOMAD: one archive per step, then the father process archive that references them.
+    By default the steps are uploaded first and the father, referencing their entry IDs, in a second upload.
+    With single_upload=True the father references the steps by mainfile and is uploaded in the same zip,
+    so there is a single upload and processing wait per process.
+
+    The archives are extracted from CAMS here (export_fair); the uploads (publish_fair) are queued in
+    the outbox and done by a background worker, unless background=False.
+    compact=True writes the archives without indentation; with write_files=False the step archives are
+    only zipped in memory, not saved in static/FAIR.
+    incremental=True re-exports a process even if it was already uploaded: only the new or changed steps
+    (content hash different from the one recorded in the IDs ledger) are uploaded, then the father is refreshed.
+    Returns the outbox job id (or the entries, if background=False), None if there is nothing to upload.
+    """
+    if (job := export_fair(item, run_id, single_upload, compact, write_files, ARCHIVE_WORKERS, incremental)) is None:
+        return None
+    if not background:
+        return publish_fair(job)
+    worker = get_worker(OUTBOX_PATH, {'publish_fair': publish_fair}, concurrency=OUTBOX_CONCURRENCY)
+    job_id = worker.enqueue('publish_fair', job, key=job['process_name'])
+    print(f"Upload of '{job['process_name']}' queued in the outbox (job {job_id}).")
+    return job_id
+
+def export_fair(item, run_id, single_upload=False, compact=False, write_files=True, workers=None, incremental=False,
+                prefetched=None, records=None):
+    """
+    Extract the run from CAMS and serialize its step archives (compact JSON if compact, in `workers`
+    processes for large runs). The archives travel in the job, in memory: the <process>_steps folder
+    is written only for inspection, if write_files. prefetched (see prefetch_step_details) can already
+    hold the details of the steps, and records (see read_runs) the run and its steps, already read from
+    the database, e.g. when many runs are exported together.
+    Returns the job for publish_fair, None if the run is missing or already uploaded (and not incremental).
+    """
+    with tracing.trace('export', TRACE_PATH, run=run_id) as trace:
+        print(f"Uploading FAIR data for run_id: {run_id}")
+        upload = True
+        main_path.mkdir(parents=True, exist_ok=True)
+        success_path = main_path / 'SUCCCESS'
+        success_path.mkdir(parents=True, exist_ok=True)
     
-    # Retrieve the run record
-    run = item.task.run.copy()
-    run.set_where(id=run_id)
-    run.open()
+        # Retrieve the run record
+        if records is not None:
+            run, steps = records
+        else:
+            with tracing.span('db_fetch', what='run'):
+                run = item.task.run.copy()
+                run.set_where(id=run_id)
+                run.open()
     
-    if not run.rec_count:
-        print("Error: No data found for this run_id")
-        return
+            if not run.rec_count:
+                print("Error: No data found for this run_id")
+                return
     
-    # Prepare the folder for this process only if it doesn't already exist in success_path
-    process_name = run.run_name.display_text  # The name of the folder to be created
-    process_path = main_path / process_name
+        # Prepare the folder for this process only if it doesn't already exist in success_path
+        process_name = run.run_name.display_text  # The name of the folder to be created
+        process_path = main_path / process_name
+        trace['process'] = process_name
     
-    # Check if the folder already exists in the success_path
-    if not (success_path / process_name).exists():
-        process_path.mkdir(parents=True, exist_ok=True)
-        print(f"Folder '{process_name}' created successfully in '{main_path}'.")
-    else:
-        print(f"Folder '{process_name}' already exists in '{success_path}', skipping creation and no uploading.")
-        return
+        # Check if the folder already exists in the success_path
+        if not (success_path / process_name).exists():
+            process_path.mkdir(parents=True, exist_ok=True)
+            print(f"Folder '{process_name}' created successfully in '{main_path}'.")
+        elif incremental:
+            process_path.mkdir(parents=True, exist_ok=True)
+            print(f"Folder '{process_name}' already exists in '{success_path}', uploading only the changes.")
+        else:
+            print(f"Folder '{process_name}' already exists in '{success_path}', skipping creation and no uploading.")
+            return
     
-    # Prepare JSON data structure
-    process_dict = get_process_dict(run)
+        # Prepare JSON data structure
+        process_dict = get_process_dict(run)
 
-    # Retrieve steps associated with the run
-    steps = run.steps
-    steps.open(order_by=['step_number'])
-    
-    
-    exclude_list = ['note', 'comments']
-    print(f"Chiavi disponibili in cams2nomad:\n{list(cams2nomad.keys())}\n")
-
-    # Prepare the folder for the steps
-    steps_path = process_path / f"{process_path.name}_steps"
-    steps_path.mkdir(parents=True, exist_ok=True)
-    for i, s in enumerate(steps):
-        # Get the common parameters
-        step_data = get_base_step_dict(s)
-        # Get the specific parameters, and update the 'notes' field in 'step_data'
-        step_data, step_specific_info = enrich_step(item, s, step_data, exclude_list)
-        # just to get caption and variable name, TO BE DELETED
-        #step_data, step_specific_info = enrich_step2(item, s, step_data, exclude_list)
-        
-        # Transform the params names to the NOMAD vocab, based on step type        
-        step_data = transform_data(s, step_data, step_specific_info)
-        if step_data is None:
-            continue # i.e. the step_type is not mapped
-        # CORRECTION TO AVOID ERRORS: remove nulls
-        step_data = {k: v for k, v in step_data.items() if v is not None}
-
-        # If we want just a single file report in static/report, simply put the 
-        # step dict in the 'step' key of the process dict
-        if not upload:
-            process_dict["steps"].append(step_data)
-            continue
+        # Retrieve steps associated with the run
+        exclude_list = EXCLUDE_LIST
+        if records is None:
+            with tracing.span('db_fetch', what='steps') as sp:
+                steps = run.steps
+                steps.open(order_by=['step_number'])
+                sp['steps'] = steps.rec_count
+        if prefetched is None:
+            with tracing.span('db_fetch', what='step details'):
+                prefetched = prefetch_step_details(item, steps, exclude_list)
+
+        # Prepare the folder for the steps
+        steps_path = process_path / f"{process_path.name}_steps"
+        if write_files:
+            steps_path.mkdir(parents=True, exist_ok=True)
+        step_files = []
+        rows = []
+        with tracing.span('enrich') as sp:
+            for i, s in enumerate(steps):
+                # Get the common parameters
+                step_data = get_base_step_dict(s)
+                # Get the specific parameters, and update the 'notes' field in 'step_data'
+                step_data, step_specific_info = enrich_step(item, s, step_data, exclude_list, prefetched)
+                rows.append((s.step_number.display_text, s.step_type.display_text, step_data, step_specific_info))
+            sp['steps'] = len(rows)
+
+        # Transform the params names to the NOMAD vocab, all the steps of a type together
+        with tracing.span('transform') as sp:
+            steps_by_type = {}
+            for n, (_, step_type_name, _, _) in enumerate(rows):
+                steps_by_type.setdefault(step_type_name, []).append(n)
+            transformed = [None] * len(rows)
+            for step_type_name, indices in steps_by_type.items():
+                batch = transform_steps(step_type_name, [(rows[n][2], rows[n][3]) for n in indices])
+                for n, step_data in zip(indices, batch):
+                    transformed[n] = step_data
+            sp['step_types'] = len(steps_by_type)
+
+        step_archives = []
+        for (step_number, _, _, _), step_data in zip(rows, transformed):
+            if step_data is None:
+                continue # i.e. the step_type is not mapped
+            # CORRECTION TO AVOID ERRORS: remove nulls
+            step_data = {k: v for k, v in step_data.items() if v is not None}
+
+            # If we want just a single file report in static/report, simply put the 
+            # step dict in the 'step' key of the process dict
+            if not upload:
+                process_dict["steps"].append(step_data)
+                continue
         
-        # format the data for NOMAD
-        step_data = {"data": step_data}
-        # save the dict in a dedicated file
-        file_step = steps_path / f"{s.step_number.display_text}.archive.json"
-        file_step.write_text(json.dumps(step_data, indent=4), encoding="utf-8")
+            # format the data for NOMAD
+            step_archives.append({"data": step_data})
+            step_files.append(steps_path / f"{step_number}.archive.json")
         
-        # DELETE THE NEXT LINE WHEN UPLOAD ID WILL BE FETCHED
-        #process_dict["steps"].append(f"{s.step_number.display_text}.archive.json")
-
-        #break # to work with just one step, for now.. 
-    if not upload:    
-        json_file_path = f'static/reports/{process_name}_{datetime.now().strftime("%Y-%m-%d_%H-%M-%S%f")}.json'
-        with open(json_file_path, 'w') as json_file:
-            json_file.write(json_output)
+            # DELETE THE NEXT LINE WHEN UPLOAD ID WILL BE FETCHED
+            #process_dict["steps"].append(f"{s.step_number.display_text}.archive.json")
+
+            #break # to work with just one step, for now.. 
+        if not upload:    
+            json_file_path = f'static/reports/{process_name}_{datetime.now().strftime("%Y-%m-%d_%H-%M-%S%f")}.json'
+            with open(json_file_path, 'w') as json_file:
+                json_file.write(json_output)
         
-    # ---------------    UPLOAD STEP PHASE    ---------------
-    print("\n\n ------ UPLOAD PHASE ------ \n\n")
-    #create zip file to upload
-    zip_file_name = process_path / f"{steps_path.name}_zpd" # name of the zip file (without the extension)
-    #shutil.make_archive(str(zip_file_name), 'zip', root_dir=steps_path, base_dir=steps_path.name)
-    shutil.make_archive(str(zip_file_name), 'zip', root_dir=steps_path.parent, base_dir=steps_path.name)
-    zip_file_path = zip_file_name.with_suffix('.zip')
-
-    if(entry_dict:=api.upload_file(zip_file_path, autodelete=False)) is None: 
-        print('Some entries have bugs...')
-        return
-
-    print(entry_dict)
-    ids_file = process_path / "IDs.json"
-    update_ids_file(entry_dict, ids_file)
-    # ---------------    UPDATE FATHER    ---------------
-    print("\n\n ------ UPDATE FATHER ------ \n\n")
-    process_dict["steps"] = [
-        f"../uploads/{upload_id}/archive/{entry_id}#data"
-        for upload_id, entries in entry_dict.items()
-        for entry_id in entries.values()
-    ]
-    # format the data for NOMAD
-    process_dict = {"data": process_dict}
-    # save the dict in a dedicated file
-    file_process = process_path / f"{process_name}.archive.json"
-    file_process.write_text(json.dumps(process_dict, indent=4), encoding="utf-8")
-    # ---------------    UPDLOAD FATHER    ---------------
-    if(father_entry:=api.upload_file(file_process, autodelete=False)) is None: # -----------   IMPORT API COLLECTION!!!! E PASSARE ARGOMENTI
-        print('Some entries have bugs...')
-        return        
-    update_ids_file(father_entry, ids_file)
-    #---------------------  output file   -------------------------------
-    # json_output = json.dumps(process_dict, indent=4, default=str)
-    # print(f'\n\nJSON FILE PREVIEW:\n{json_output}')
-    print('\n\n' + '*'*60 + f'\n*{" " * 15}THE UPLOAD PROCESS SUCCEEDED{" " * 15}*\n' + '*'*60 + '\n')
-    return    
+        # serialize the step archives, the mainfile is the path in the upload
+        with tracing.span('serialize', archives=len(step_archives)) as sp:
+            texts = api.serialize_archives(step_archives, compact, workers)
+            sp['bytes'] = sum(len(text) for text in texts)
+        archives = []
+        for file_step, text in zip(step_files, texts):
+            if write_files:
+                file_step.write_text(text, encoding="utf-8")
+            archives.append([file_step.relative_to(process_path).as_posix(), text])
+
+        return {
+            "process_name": process_name,
+            "process_path": str(process_path),
+            "archives": archives,
+            "process_dict": process_dict,
+            "single_upload": single_upload,
+            "compact": compact,
+        }
+
+def group_references(references):
+    """mainfile -> (upload_id, entry_id) references as the {upload_id: {mainfile: entry_id}} dict of the IDs ledger"""
+    entry_dict = {}
+    for mainfile, (upload_id, entry_id) in references.items():
+        entry_dict.setdefault(upload_id, {})[mainfile] = entry_id
+    return entry_dict
+
+def select_runs(item, run_ids=None, start_date=None, end_date=None, project=None):
+    """IDs of the runs matching all the given filters (run IDs, start_date range, project ID), with one query"""
+    where = {}
+    if run_ids is not None:
+        where["id__in"] = list(run_ids)
+    if start_date is not None:
+        where["start_date__ge"] = start_date
+    if end_date is not None:
+        where["start_date__le"] = end_date
+    if project is not None:
+        where["project"] = project
+    run = item.task.run.copy()
+    run.set_where(**where)
+    run.open(order_by=['start_date'])
+    return [run.id.value for _ in run]
+
+def freeze_record(dataset):
+    """Copy of the current record of an open dataset, whose fields are read as the dataset ones
+    (record.field.value, .display_text, ...) after the dataset has moved on, also from other threads."""
+    record = SimpleNamespace(task=dataset.task)
+    for field in dataset.fields:
+        setattr(record, field.field_name, SimpleNamespace(
+            field_name=field.field_name, field_caption=field.field_caption, value=field.value,
+            display_text=field.display_text, lookup_text=field.lookup_text))
+    return record
+
+def read_runs(item, run_ids):
+    """
+    Read the runs and the steps of all of them with one query each.
+    Returns {run_id: (run, steps)}: the run record and the list of its step records, ordered by
+    step_number (see freeze_record), for export_fair.
+    """
+    run = item.task.run.copy()
+    run.set_where(id__in=list(run_ids))
+    run.open()
+    records = {run.id.value: (freeze_record(run), []) for _ in run}
+    master = steps_master(item.task)
+    where = {master['field'] + '__in': list(records)}
+    if master['master_id']:
+        where[master['master_id'][0]] = master['master_id'][1]
+    steps = item.task.item_by_ID(item.task.run.steps.ID).copy()
+    steps.set_where(**where)
+    steps.open(order_by=[master['field'], 'step_number'])
+    for _ in steps:
+        records[steps.field_by_name(master['field']).value][1].append(freeze_record(steps))
+    return records
+
+def bulk_upload_fair(item, run_ids=None, start_date=None, end_date=None, project=None,
+                     db_workers=1, upload_workers=4, **export_options):
+    """
+    Export to NOMAD all the runs matching the filters (see select_runs), e.g. to backfill a year of runs.
+    item can also be loaded from a snapshot of the database, CamsSnapshot(SNAPSHOT_PATH).load(...) (see copy_db).
+    The runs, their steps (read_runs) and the step details are read for all the runs together, then db_workers
+    threads extract the runs (export_fair) and, as each one is ready, upload_workers threads upload it
+    (publish_fair). export_options are passed to export_fair (single_upload, compact, write_files, incremental).
+    Returns {run_id: status dict}; the status of each run and the total throughput are printed at the end.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    start_time = time.time()
+    run_ids = select_runs(item, run_ids, start_date, end_date, project)
+    print(f"Bulk export of {len(run_ids)} runs")
+    records = read_runs(item, run_ids) if run_ids else {}
+    prefetched = prefetch_step_details(item, [s for _, steps in records.values() for s in steps], EXCLUDE_LIST)
+    status = {run_id: {"status": "pending"} for run_id in run_ids}
+
+    def publish(run_id, job):
+        started = time.time()
+        entries = publish_fair(job)
+        status[run_id].update(status="uploaded" if entries else "empty" if entries == {} else "failed",
+                              upload_time=time.time() - started)
+        return entries
+
+    with ThreadPoolExecutor(max(1, db_workers)) as db_pool, ThreadPoolExecutor(max(1, upload_workers)) as upload_pool:
+        exports = {
+            db_pool.submit(export_fair, item, run_id, workers=ARCHIVE_WORKERS, prefetched=prefetched,
+                           records=records.get(run_id), **export_options): run_id
+            for run_id in run_ids
+        }
+        uploads = []
+        for future in as_completed(exports):
+            run_id = exports[future]
+            try:
+                job = future.result()
+            except Exception as e:
+                status[run_id] = {"status": "failed", "error": f"export: {e!r}"}
+                continue
+            if job is None:
+                status[run_id] = {"status": "skipped"}
+                continue
+            status[run_id] = {"process": job["process_name"], "status": "exported", "steps": len(job["archives"])}
+            uploads.append(upload_pool.submit(publish, run_id, job))
+        for future in uploads:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Upload failed: {e!r}")
+        for run_id, run_status in status.items():
+            if run_status["status"] == "exported":  # publish raised
+                run_status["status"] = "failed"
+
+    elapsed = time.time() - start_time
+    counts = {}
+    for run_id, run_status in status.items():
+        counts[run_status["status"]] = counts.get(run_status["status"], 0) + 1
+        print(f"run {run_id} {run_status.get('process', '')}: {run_status['status']}")
+    print(f"{len(run_ids)} runs in {elapsed:.1f} s ({60 * counts.get('uploaded', 0) / elapsed:.1f} runs uploaded per minute): {counts}")
+    return status
+
+def publish_fair(job):
+    """
+    Upload phase of upload_fair, for a job returned by export_fair (also the outbox handler).
+    Step archives whose content was already uploaded (recorded in the IDs ledger, or in ARCHIVE_INDEX_PATH)
+    are not uploaded again: the father references their existing entries, and is uploaded again only
+    if some step changed.
+    Returns the entries of the father process, {} if the process has no step to upload
+    (e.g. no step type is mapped), False if NOMAD failed to process some entries (the outbox
+    does not retry it), None if something else went wrong.
+    """
+    process_name = job["process_name"]
+    process_path = Path(job["process_path"])
+    archives = [tuple(archive) for archive in job["archives"]]
+    process_dict = job["process_dict"]
+    compact = job.get("compact", False)
+    if not archives:
+        print(f"No step archives for '{process_name}', nothing to upload.")
+        return {}
+    with tracing.trace('publish', TRACE_PATH, process=process_name):
+        ids_file = process_path / "IDs.json"  # before IDS_LEDGER_PATH, still read
+        ledger = get_ledger(IDS_LEDGER_PATH)
+        file_process = process_path / f"{process_name}.archive.json"
+        index = RecordedArchives(ledger.recorded_archives(process_name, ids_file), ArchiveIndex(ARCHIVE_INDEX_PATH))
+
+        # ---------------    UPLOAD STEP PHASE    ---------------
+        print("\n\n ------ UPLOAD PHASE ------ \n\n")
+        if job["single_upload"]:
+            # the father goes in the same upload, referencing the new steps by their path in the zip
+            known, _ = api.find_uploaded_archives(archives, index)
+            process_dict["steps"] = [
+                f"../uploads/{known[mainfile][0]}/archive/{known[mainfile][1]}#data" if mainfile in known
+                else f"../upload/archive/mainfile/{mainfile}#data"
+                for mainfile, _ in archives
+            ]
+            with tracing.span('father') as sp:
+                father = api.dump_archive({"data": process_dict}, compact)
+                sp['bytes'] = len(father)
+            file_process.write_text(father, encoding="utf-8")
+            archives.append((file_process.name, father))
+            references, success = api.upload_archives(archives, f"{process_name}_steps_zpd.zip", index)
+            if not success:
+                print('Some entries have bugs...')
+                return references  # False: processing failed, not worth a retry
+            entry_dict = group_references(references)
+            ledger.record_upload(process_name, entry_dict)
+            ledger.record_archives(process_name, archives, references)
+            print('\n\n' + '*'*60 + f'\n*{" " * 15}THE UPLOAD PROCESS SUCCEEDED{" " * 15}*\n' + '*'*60 + '\n')
+            return entry_dict
+
+        references, success = api.upload_archives(archives, f"{process_name}_steps_zpd.zip", index)
+        if not success:
+            print('Some entries have bugs...')
+            return references
 
+        entry_dict = group_references(references)
+        print(entry_dict)
+        ledger.record_upload(process_name, entry_dict)
+        ledger.record_archives(process_name, archives, references)
+        # ---------------    UPDATE FATHER    ---------------
+        print("\n\n ------ UPDATE FATHER ------ \n\n")
+        with tracing.span('father') as sp:
+            process_dict["steps"] = [
+                f"../uploads/{upload_id}/archive/{entry_id}#data"
+                for upload_id, entry_id in references.values()
+            ]
+            # format the data for NOMAD
+            process_dict = {"data": process_dict}
+            # save the dict in a dedicated file
+            father = api.dump_archive(process_dict, compact)
+            sp['bytes'] = len(father)
+            file_process.write_text(father, encoding="utf-8")
+            # ---------------    UPDLOAD FATHER    ---------------
+            father_archives = [(file_process.name, father)]
+            father_references, success = api.upload_archives(father_archives, f"{process_name}_zpd.zip", index)
+        if not success:
+            print('Some entries have bugs...')
+            return father_references
+        father_entry = group_references(father_references)
+        ledger.record_upload(process_name, father_entry)
+        ledger.record_archives(process_name, father_archives, father_references)
+        #---------------------  output file   -------------------------------
+        # json_output = json.dumps(process_dict, indent=4, default=str)
+        # print(f'\n\nJSON FILE PREVIEW:\n{json_output}')
+        print('\n\n' + '*'*60 + f'\n*{" " * 15}THE UPLOAD PROCESS SUCCEEDED{" " * 15}*\n' + '*'*60 + '\n')
+        return father_entry
@@ -0,0 +1,77 @@
+"""
+Local index of the archives already uploaded to NOMAD: sha256 of the content of an
+*.archive.json -> (upload_id, entry_id), per NOMAD server. API_collection.upload_archives
+uses it to skip the archives that did not change and reuse their entries.
+"""
+import time
+import sqlite3
+import hashlib
+from contextlib import contextmanager
+from pathlib import Path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+    nomad_url TEXT NOT NULL,
+    hash      TEXT NOT NULL,
+    upload_id TEXT NOT NULL,
+    entry_id  TEXT NOT NULL,
+    mainfile  TEXT,
+    updated   REAL NOT NULL,
+    PRIMARY KEY (nomad_url, hash)
+);
+"""
+
+
+def content_hash(data):
+    '''sha256 hex digest of bytes (or str, encoded as utf-8).'''
+    return hashlib.sha256(data.encode('utf-8') if isinstance(data, str) else data).hexdigest()
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    '''sha256 hex digest of the content of a file.'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ArchiveIndex:
+    """
+    SQLite index content hash -> (upload_id, entry_id) of the uploaded archives.
+
+    Args:
+        db_path (str or Path): SQLite file of the index (created if missing).
+    """
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as con:
+            con.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        con = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)  # autocommit
+        try:
+            con.execute('PRAGMA journal_mode=WAL')
+            yield con
+        finally:
+            con.close()
+
+    def get(self, nomad_url, content_hash):
+        '''(upload_id, entry_id) of the archive with this content, None if never uploaded.'''
+        with self._connect() as con:
+            row = con.execute('SELECT upload_id, entry_id FROM archives WHERE nomad_url = ? AND hash = ?',
+                              (nomad_url, content_hash)).fetchone()
+        return tuple(row) if row else None
+
+    def add(self, nomad_url, content_hash, upload_id, entry_id, mainfile=None):
+        with self._connect() as con:
+            con.execute('INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?, ?, ?)',
+                        (nomad_url, content_hash, upload_id, entry_id, mainfile, time.time()))
+
+    def forget_upload(self, nomad_url, upload_id):
+        '''Remove the archives of an upload (e.g. after deleting it from NOMAD).'''
+        with self._connect() as con:
+            return con.execute('DELETE FROM archives WHERE nomad_url = ? AND upload_id = ?',
+                               (nomad_url, upload_id)).rowcount
@@ -0,0 +1,129 @@
+"""
+Load benchmark of the NOMAD clients against the local stub (nomad_stub_server.py)
+or against a real server (--url).
+
+N zip files of M step archives each are uploaded with the upload -> wait -> fetch entries
+pipeline, `concurrency` at a time, and the harness reports uploads per minute, the number
+of status polls and the percentiles of the end-to-end latency of the uploads:
+
+    python benchmark_nomad.py --uploads 50 --entries 20 --concurrency 8 --processing-delay 2
+    python benchmark_nomad.py --client async --failure-rate 0.05 --json results.json
+"""
+import io
+import os
+import sys
+import json
+import time
+import zipfile
+import argparse
+import tempfile
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+import API_collection as api
+from nomad_stub_server import NomadStubServer
+
+
+def make_zips(folder, n_uploads, n_entries, entry_size=2048):
+    '''Write n_uploads zip files of n_entries dummy step archives, return their paths.'''
+    paths = []
+    for i in range(n_uploads):
+        path = os.path.join(folder, f'process{i}_steps_zpd.zip')
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for n in range(n_entries):
+                step = {'data': {'name': f'step {n}', 'notes': os.urandom(entry_size // 2).hex()}}
+                zf.writestr(f'process{i}_steps/{n + 1}.archive.json', json.dumps(step))
+        paths.append(path)
+    return paths
+
+
+def percentiles(values, qs=(50, 90, 99)):
+    if not values:
+        return {f'p{q}': None for q in qs}
+    values = sorted(values)
+    return {f'p{q}': values[min(len(values) - 1, round(q / 100 * (len(values) - 1)))] for q in qs}
+
+
+def run_sync(paths, nomad_url, concurrency):
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda path: api.upload_file(path, nomad_url=nomad_url), paths))
+    return results, api.get_client(nomad_url).upload_stats
+
+
+def run_async(paths, nomad_url, concurrency):
+    import asyncio
+    from API_collection_async import AsyncNomadClient
+
+    async def run():
+        async with AsyncNomadClient(nomad_url, limit=concurrency * 2) as client:
+            results = {path: result async for path, result in client.upload_many(paths, limit=concurrency)}
+            return [results[path] for path in paths], client.upload_stats
+    return asyncio.run(run())
+
+
+def benchmark(nomad_url, paths, concurrency=4, client='sync', verbose=False):
+    '''Upload all paths and return a dict with throughput, polls and latency statistics.'''
+    runner = run_async if client == 'async' else run_sync
+    start_time = time.time()
+    with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+        results, upload_stats = runner(paths, nomad_url, concurrency)
+    elapsed = time.time() - start_time
+
+    succeeded = [r for r in results if r]
+    stats = [upload_stats[upload_id] for r in succeeded for upload_id in r if upload_id in upload_stats]
+    latencies = [s['total_time'] for s in stats if 'total_time' in s]
+    polls = [s.get('polls', 0) for s in stats]
+    return {
+        'client': client,
+        'uploads': len(paths),
+        'succeeded': len(succeeded),
+        'failed': len(paths) - len(succeeded),
+        'concurrency': concurrency,
+        'elapsed': elapsed,
+        'uploads_per_minute': 60 * len(succeeded) / elapsed if elapsed else None,
+        'polls_total': sum(polls),
+        'polls_per_upload': sum(polls) / len(polls) if polls else None,
+        'latency': percentiles(latencies),
+        'processing_time': percentiles([s['processing_time'] for s in stats if 'processing_time' in s]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load benchmark of the NOMAD upload clients.')
+    parser.add_argument('--url', help='NOMAD API to benchmark (default: a local stub server)')
+    parser.add_argument('--client', choices=('sync', 'async'), default='sync')
+    parser.add_argument('--uploads', type=int, default=20, help='number of uploads')
+    parser.add_argument('--entries', type=int, default=10, help='step archives per upload')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--processing-delay', type=float, default=1.0, help='stub processing time [s]')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='stub probability of a 503')
+    parser.add_argument('--entry-failure-rate', type=float, default=0.0)
+    parser.add_argument('--response-delay', type=float, default=0.0, help='stub latency of every response [s]')
+    parser.add_argument('--json', help='write the results in this file')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the clients')
+    args = parser.parse_args()
+
+    server = None
+    if args.url is None:
+        server = NomadStubServer(processing_delay=args.processing_delay, failure_rate=args.failure_rate,
+                                 entry_failure_rate=args.entry_failure_rate,
+                                 response_delay=args.response_delay).start()
+    nomad_url = args.url or server.url
+    try:
+        with tempfile.TemporaryDirectory() as folder:
+            paths = make_zips(folder, args.uploads, args.entries)
+            results = benchmark(nomad_url, paths, args.concurrency, args.client, args.verbose)
+    finally:
+        if server is not None:
+            server.stop()
+    if server is not None:
+        results['server_requests'] = dict(server.stats)
+
+    print(json.dumps(results, indent=4))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
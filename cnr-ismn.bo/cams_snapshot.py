@@ -0,0 +1,361 @@
+"""
+Extraction of the CAMS runs from a read-only SQLite snapshot of the database (or from the
+live SQLite database) with a few set-based SQL queries, instead of one Jam.py dataset query
+per record: large exports do not load the live LIMS and run at SQL speed.
+
+The snapshot is a copy of the database plus the description of the tables read from the
+Jam.py items (table and column names, captions, lookups), saved next to it:
+
+    create_snapshot(task, 'static/FAIR/cleanroom.sqlite')          # from the server, with Jam.py
+
+    snapshot = CamsSnapshot('static/FAIR/cleanroom.sqlite')         # anywhere, without Jam.py
+    item = snapshot.load(start_date=date(2024, 1, 1), end_date=date(2024, 12, 31))
+    bulk_upload_fair(item, db_workers=4)
+
+load() reads the selected runs, their steps, the step types with the field_order of their
+catalog and the specific records of the steps (one query per step table), and returns an
+item whose datasets (item.task.run, run.steps, item.task.item_by_ID(...), ...) behave like
+the Jam.py ones used by export_fair, filtering the loaded records in memory.
+"""
+import json
+import sqlite3
+from pathlib import Path
+from contextlib import closing
+from datetime import date, datetime
+
+# Jam.py field data types (jam.common)
+DATE, DATETIME, BOOLEAN = 4, 5, 6
+
+# items read by export_fair, besides the step records
+RUN, STEPS, STEP_TYPE, CATALOG_STEP_TYPE = 'run', 'steps', 'step_type', 'catalogs.step_type'
+
+
+def schema_path(db_path):
+    return Path(str(db_path) + '.schema.json')
+
+
+def read_item_schema(item):
+    '''Table, columns, captions and lookups of a Jam.py item.'''
+    fields = {}
+    for field in item.fields:
+        info = {
+            'db': field.db_field_name,
+            'caption': field.field_caption,
+            'data_type': field.data_type,
+            'system': bool(field.system_field()),
+        }
+        lookup_item = getattr(field, 'lookup_item', None)
+        if isinstance(lookup_item, int):
+            lookup_item = item.task.item_by_ID(lookup_item)
+        if lookup_item is not None and field.lookup_field:
+            info['lookup'] = {'table': lookup_item.table_name,
+                              'db': lookup_item.field_by_name(field.lookup_field).db_field_name,
+                              'key': lookup_item._primary_key_db_field_name}
+        elif getattr(field, 'lookup_values', None):
+            info['values'] = {str(value): text for value, text in field.lookup_values}
+        fields[field.field_name] = info
+    return {'ID': item.ID, 'table': item.table_name, 'key': item._primary_key,
+            'deleted': item._deleted_flag or None, 'fields': fields}
+
+
+def steps_master(task):
+    '''How run.steps is linked to the run: the field of the steps with the run id and, for the steps
+    detail shared by many items, (master_id field, ID of the run item); from the schema for a snapshot.'''
+    if isinstance(task, SnapshotTask):
+        return task.steps_master
+    steps = task.run.steps
+    master_field = getattr(steps, 'master_field', None)
+    return {
+        'field': getattr(master_field, 'field_name', master_field) or steps._master_rec_id,
+        'master_id': None if master_field else (steps._master_id, task.run.ID),
+    }
+
+
+def read_schema(task):
+    '''Description of the tables read by export_fair: run, steps, step_type, catalogs.step_type
+    and the items of all the step types.'''
+    steps = task.run.steps
+    schema = {
+        RUN: read_item_schema(task.run),
+        STEPS: read_item_schema(steps),
+        STEP_TYPE: read_item_schema(task.step_type),
+        CATALOG_STEP_TYPE: read_item_schema(task.catalogs.step_type),
+        # how run.steps is linked to the run: a field with the run id, or master_id + master_rec_id
+        'steps_master': steps_master(task),
+        'step_items': {},
+    }
+    step_type = task.step_type.copy()
+    step_type.open()
+    for _ in step_type:
+        if (item_id := step_type.step_type.value) is not None:
+            schema['step_items'][str(item_id)] = read_item_schema(task.item_by_ID(item_id))
+    return schema
+
+
+def create_snapshot(task, db_path, source_db=None):
+    '''
+    Copy the CAMS database in the SQLite file db_path and save its schema next to it.
+    If the live database is SQLite, source_db is its path and the copy is an online backup
+    (consistent, readers are not blocked); otherwise it is copied by Jam.py.
+    '''
+    db_path = Path(db_path)
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    schema = read_schema(task)
+    db_path.unlink(missing_ok=True)
+    if source_db is not None:
+        with closing(sqlite3.connect(f'file:{Path(source_db).resolve().as_posix()}?mode=ro', uri=True)) as source, \
+                closing(sqlite3.connect(db_path)) as copy:
+            source.backup(copy)
+    else:
+        from jam.db.db_modules import SQLITE
+        task.copy_database(SQLITE, str(db_path))
+    schema_path(db_path).write_text(json.dumps(schema, indent=4), encoding='utf-8')
+    return db_path
+
+
+def convert(value, data_type):
+    '''SQLite value -> python value of a Jam.py field.'''
+    if value is None:
+        return None
+    if data_type == DATE and isinstance(value, str):
+        return date.fromisoformat(value[:10])
+    if data_type == DATETIME and isinstance(value, str):
+        return datetime.fromisoformat(value)
+    if data_type == BOOLEAN:
+        return bool(value)
+    return value
+
+
+def column(item, field_name, alias='t'):
+    return f'{alias}."{item["fields"][field_name]["db"]}"'
+
+
+class CamsSnapshot:
+    """
+    Read-only connection to a SQLite copy of CAMS (see create_snapshot) or to the live SQLite database.
+
+    Args:
+        db_path (str or Path): SQLite database.
+        schema (dict): Tables description (see read_schema), by default the one saved with the snapshot.
+    """
+    def __init__(self, db_path, schema=None):
+        self.db_path = Path(db_path)
+        self.schema = schema or json.loads(schema_path(self.db_path).read_text(encoding='utf-8'))
+
+    def _connect(self):
+        return closing(sqlite3.connect(f'file:{self.db_path.resolve().as_posix()}?mode=ro', uri=True, timeout=30))
+
+    @classmethod
+    def _select(cls, con, item, where, params):
+        '''Rows of an item (not deleted) as {field_name: value, field_name + "__lookup": text}, lookups joined.'''
+        columns, joins, names = [], [], []
+        for name, info in item['fields'].items():
+            columns.append(f't."{info["db"]}"')
+            names.append(name)
+            if 'lookup' in info:
+                lookup, alias = info['lookup'], f'l{len(joins)}'
+                joins.append(f'LEFT JOIN "{lookup["table"]}" {alias} ON {alias}."{lookup["key"]}" = t."{info["db"]}"')
+                columns.append(f'{alias}."{lookup["db"]}"')
+                names.append(name + '__lookup')
+        sql = f'SELECT {", ".join(columns)} FROM "{item["table"]}" t {" ".join(joins)} WHERE {cls._alive(item, "t")} AND {where}'
+        data_types = {name: info['data_type'] for name, info in item['fields'].items()}
+        return [{name: convert(value, data_types.get(name)) for name, value in zip(names, row)}
+                for row in con.execute(sql, params)]
+
+    @staticmethod
+    def _alive(item, alias):
+        '''condition excluding the soft-deleted records'''
+        return f'{column(item, item["deleted"], alias)} = 0' if item.get('deleted') else '1'
+
+    def load(self, run_ids=None, start_date=None, end_date=None, project=None):
+        '''Read the runs matching all the filters (as BUTTON_UPLOAD_FAIR.select_runs) with all their
+        steps and step records. Returns an item for export_fair / bulk_upload_fair.'''
+        schema = self.schema
+        run, steps, step_type, catalog = schema[RUN], schema[STEPS], schema[STEP_TYPE], schema[CATALOG_STEP_TYPE]
+        params = {}
+        conditions = [self._alive(run, 'r')]
+        if run_ids is not None:
+            conditions.append(f'{column(run, run["key"], "r")} IN (SELECT value FROM json_each(:run_ids))')
+            params['run_ids'] = json.dumps(list(run_ids))
+        if start_date is not None:
+            conditions.append(f'{column(run, "start_date", "r")} >= :start_date')
+            params['start_date'] = start_date.isoformat()
+        if end_date is not None:
+            conditions.append(f'{column(run, "start_date", "r")} <= :end_date')
+            params['end_date'] = end_date.isoformat()
+        if project is not None:
+            conditions.append(f'{column(run, "project", "r")} = :project')
+            params['project'] = project
+        # the subqueries the other tables are joined to: the selected runs, their steps and step types
+        runs_sql = f'SELECT {column(run, run["key"], "r")} FROM "{run["table"]}" r WHERE {" AND ".join(conditions)}'
+        master = schema['steps_master']
+
+        def steps_where(alias):
+            where = f'{column(steps, master["field"], alias)} IN ({runs_sql})'
+            if master['master_id']:
+                where += f' AND {column(steps, master["master_id"][0], alias)} = :master_id'
+            return where
+        if master['master_id']:
+            params['master_id'] = master['master_id'][1]
+        steps_sql = f'SELECT {column(steps, "step_type", "s")} AS step_type, {column(steps, "step_rec_id", "s")} ' \
+                    f'AS step_rec_id FROM "{steps["table"]}" s WHERE {self._alive(steps, "s")} AND {steps_where("s")}'
+        step_types_sql = f'SELECT {column(step_type, step_type["key"], "st")} AS id, ' \
+                         f'{column(step_type, "step_type", "st")} AS item_id FROM "{step_type["table"]}" st ' \
+                         f'WHERE {column(step_type, step_type["key"], "st")} IN (SELECT step_type FROM ({steps_sql}))'
+
+        with self._connect() as con:
+            tables = {
+                RUN: self._select(con, run, f'{column(run, run["key"])} IN ({runs_sql})', params),
+                STEPS: self._select(con, steps, steps_where('t'), params),
+                STEP_TYPE: self._select(con, step_type, f'{column(step_type, step_type["key"])} IN '
+                                                        f'(SELECT id FROM ({step_types_sql}))', params),
+                CATALOG_STEP_TYPE: self._select(con, catalog, f'{column(catalog, "step_type")} IN '
+                                                              f'(SELECT item_id FROM ({step_types_sql}))', params),
+            }
+            # one query per step table: the records of the selected steps of that type
+            step_items = {}
+            for item_id in {row['step_type'] for row in tables[STEP_TYPE]}:
+                if (item := schema['step_items'].get(str(item_id))) is None:
+                    continue
+                step_items[item_id] = self._select(
+                    con, item, f'{column(item, item["key"])} IN (SELECT s.step_rec_id FROM ({steps_sql}) s '
+                               f'JOIN ({step_types_sql}) st ON st.id = s.step_type WHERE st.item_id = :item_id)',
+                    {**params, 'item_id': item_id})
+        return SnapshotItem(schema, tables, step_items, master['field'])
+
+
+class SnapshotField:
+    """A field of the current record of a SnapshotDataset, as the Jam.py fields used by export_fair."""
+    def __init__(self, dataset, field_name):
+        self.dataset = dataset
+        self.field_name = field_name
+        self.info = dataset.schema['fields'][field_name]
+
+    @property
+    def value(self):
+        return self.dataset.record.get(self.field_name)
+
+    @property
+    def lookup_text(self):
+        if 'lookup' in self.info:
+            return self.dataset.record.get(self.field_name + '__lookup')
+        if 'values' in self.info and self.value is not None:
+            return self.info['values'].get(str(self.value))
+        return None
+
+    @property
+    def display_text(self):
+        if 'lookup' in self.info or 'values' in self.info:
+            text = self.lookup_text
+            return '' if text is None else str(text)
+        return '' if self.value is None else str(self.value)
+
+    @property
+    def field_caption(self):
+        return self.info['caption']
+
+    def system_field(self):
+        return self.info['system']
+
+
+class SnapshotDataset:
+    """In-memory dataset of the records of an item loaded by CamsSnapshot.load."""
+    def __init__(self, task, name, schema, records, master=None):
+        self.task = task
+        self.item_name = name
+        self.ID = schema['ID']
+        self.schema = schema
+        self._records = records
+        self._master = master or {}
+        self._where = {}
+        self._rows = []
+        self.record = {}
+
+    def copy(self):
+        return SnapshotDataset(self.task, self.item_name, self.schema, self._records, self._master)
+
+    def set_where(self, **where):
+        self._where = where
+
+    def _match(self, row):
+        for key, value in {**self._where, **self._master}.items():
+            name, _, op = key.partition('__')
+            field_value = row.get(name)
+            if op == 'in':
+                if field_value not in value:
+                    return False
+            elif op in ('ge', 'le'):
+                if field_value is None or (field_value < value if op == 'ge' else field_value > value):
+                    return False
+            elif field_value != value:
+                return False
+        return True
+
+    def open(self, order_by=None):
+        self._rows = [row for row in self._records if self._match(row)]
+        for name in reversed(order_by or []):
+            descending = name.startswith('-')
+            name = name.lstrip('-')
+            self._rows.sort(key=lambda row: (row.get(name) is not None, row.get(name)), reverse=descending)
+        self.record = self._rows[0] if self._rows else {}
+
+    @property
+    def rec_count(self):
+        return len(self._rows)
+
+    def __iter__(self):
+        for row in self._rows:
+            self.record = row
+            yield self
+
+    @property
+    def fields(self):
+        return [SnapshotField(self, field_name) for field_name in self.schema['fields']]
+
+    def field_by_name(self, field_name):
+        return SnapshotField(self, field_name) if field_name in self.schema['fields'] else None
+
+    def __getattr__(self, name):
+        if name.startswith('_') or 'schema' not in self.__dict__:
+            raise AttributeError(name)
+        if name == STEPS and self.item_name == RUN:
+            return self.task.steps_of(self.record.get(self.schema['key']))
+        if name in self.schema['fields']:
+            return SnapshotField(self, name)
+        raise AttributeError(name)
+
+
+class SnapshotTask:
+    def __init__(self, schema, tables, step_items, master_field):
+        self._schema = schema
+        self._tables = tables
+        self._master_field = master_field
+        self.run = SnapshotDataset(self, RUN, schema[RUN], tables[RUN])
+        self.step_type = SnapshotDataset(self, STEP_TYPE, schema[STEP_TYPE], tables[STEP_TYPE])
+        self.catalogs = type('Catalogs', (), {})()
+        self.catalogs.step_type = SnapshotDataset(self, CATALOG_STEP_TYPE, schema[CATALOG_STEP_TYPE],
+                                                  tables[CATALOG_STEP_TYPE])
+        self._step_items = {
+            item_id: SnapshotDataset(self, schema['step_items'][str(item_id)]['table'],
+                                     schema['step_items'][str(item_id)], records)
+            for item_id, records in step_items.items()
+        }
+
+    def steps_of(self, run_id):
+        '''run.steps: the steps of a run'''
+        return SnapshotDataset(self, STEPS, self._schema[STEPS], self._tables[STEPS], {self._master_field: run_id})
+
+    @property
+    def steps_master(self):
+        return self._schema['steps_master']
+
+    def item_by_ID(self, item_id):
+        if item_id == self._schema[STEPS]['ID']:  # the steps of all the runs
+            return SnapshotDataset(self, STEPS, self._schema[STEPS], self._tables[STEPS])
+        return self._step_items[item_id]
+
+
+class SnapshotItem:
+    """Stand-in of the Jam.py item passed to export_fair: only item.task is used."""
+    def __init__(self, schema, tables, step_items, master_field):
+        self.task = SnapshotTask(schema, tables, step_items, master_field)
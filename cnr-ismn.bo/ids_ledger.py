@@ -0,0 +1,133 @@
+"""
+Append-only ledger of the NOMAD upload and entry IDs of the exported processes, replacing the
+IDs.json rewritten at every update: one JSON line per event, appended under a file lock, so
+parallel exports (threads or processes) can record their IDs safely and the cost of a record
+does not grow with the ledger. Lookups go through an in-memory index, which reads only the
+lines appended since the last lookup.
+
+    ledger = get_ledger('static/FAIR/ids.jsonl')
+    ledger.record_upload('RUN1', {upload_id: {mainfile: entry_id}})
+    ledger.record_archives('RUN1', archives, references)
+    ledger.ids('RUN1')                 # same layout as the old IDs.json
+    ledger.recorded_archives('RUN1')   # mainfile -> {"hash", "upload_id", "entry_id"}
+
+The processes exported before the ledger are read from their old IDs.json (legacy_file).
+"""
+import os
+import json
+import time
+import threading
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows: only the threads of this process are serialized
+    fcntl = None
+
+from archive_index import content_hash
+
+
+def read_ids_file(file_path):
+    '''Content of an old IDs.json, {} if missing or invalid.'''
+    try:
+        data = json.loads(Path(file_path).read_text(encoding='utf-8'))
+        return data if isinstance(data, dict) else {}
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+class IdsLedger:
+    """
+    JSON lines ledger of the uploads and archives of the processes.
+
+    Args:
+        path (str or Path): Ledger file (created if missing).
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._offset = 0
+        self._processes = {}
+
+    def _append(self, record):
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+        with self._lock:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                os.write(fd, line)  # a single write: the line is never interleaved with others
+                os.fsync(fd)
+            finally:
+                os.close(fd)  # releases the lock
+
+    def _apply(self, record):
+        '''Fold a record in the index, with the semantics of the old update_ids_file.'''
+        ids = self._processes.setdefault(record['process'], {})
+        if record['type'] == 'upload':
+            entry_dict = record['entries']
+            if entry_dict:  # empty ones were written by older versions
+                ids['upload_steps_id'] = entry_dict[next(iter(entry_dict))]
+                ids.update(entry_dict)
+        elif record['type'] == 'archives':
+            ids.setdefault('archives', {}).update(record['archives'])
+
+    def _refresh(self):
+        '''Read the complete lines appended since the last call (also by other processes).'''
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        end = data.rfind(b'\n') + 1  # a line being written is read next time
+        for line in data[:end].splitlines():
+            if line.strip():
+                self._apply(json.loads(line))
+        self._offset += end
+
+    def record_upload(self, process, entry_dict):
+        '''Record the {upload_id: {mainfile: entry_id}} entries of an upload of the process.'''
+        if not entry_dict:
+            raise ValueError(f"No entries to record for the upload of {process}")
+        self._append({'type': 'upload', 'time': time.time(), 'process': process, 'entries': entry_dict})
+
+    def record_archives(self, process, archives, references):
+        '''Record the content hash and the entry of each uploaded (mainfile, data) archive, so that
+        an incremental re-export can tell which steps changed.'''
+        recorded = {}
+        for mainfile, data in archives:
+            upload_id, entry_id = references[mainfile]
+            recorded[mainfile] = {'hash': content_hash(data), 'upload_id': upload_id, 'entry_id': entry_id}
+        self._append({'type': 'archives', 'time': time.time(), 'process': process, 'archives': recorded})
+
+    def ids(self, process, legacy_file=None):
+        '''IDs of the process in the layout of IDs.json: upload_steps_id, upload_id -> entries, archives.
+        The IDs recorded before the ledger are read from legacy_file (the old IDs.json of the process).'''
+        with self._lock:
+            self._refresh()
+            recorded = json.loads(json.dumps(self._processes.get(process, {})))  # a copy
+        ids = read_ids_file(legacy_file) if legacy_file is not None else {}
+        legacy_archives = ids.get('archives')
+        archives = {**(legacy_archives if isinstance(legacy_archives, dict) else {}), **recorded.pop('archives', {})}
+        ids.update(recorded)
+        if archives:
+            ids['archives'] = archives
+        return ids
+
+    def recorded_archives(self, process, legacy_file=None):
+        '''mainfile -> {"hash", "upload_id", "entry_id"} of the archives recorded for the process.'''
+        return self.ids(process, legacy_file).get('archives', {})
+
+
+_ledgers = {}
+_ledgers_lock = threading.Lock()
+
+def get_ledger(path):
+    """Return the IdsLedger of path shared by this process (one in-memory index per file)."""
+    with _ledgers_lock:
+        key = str(Path(path).resolve())
+        if key not in _ledgers:
+            _ledgers[key] = IdsLedger(path)
+        return _ledgers[key]
@@ -0,0 +1,292 @@
+"""
+Local stand-in of the NOMAD API, for testing API_collection.py and upload_fair offline
+and for load benchmarks (see benchmark_nomad.py).
+
+It implements only the endpoints used by the clients:
+    GET    auth/token                 -> JWT-like access token (with the "exp" claim)
+    POST   uploads                    -> new upload (the body is the file, zip files are listed)
+    PUT    uploads/{id}/raw/          -> add a file to an existing upload
+    GET    uploads/{id}               -> processing status
+    GET    uploads/{id}/entries       -> paginated entries (page, page_size)
+    DELETE uploads/{id}
+
+Every *.archive.json in the uploaded zip files becomes an entry. Processing of an upload
+takes processing_delay seconds (plus processing_delay_per_mb for each MB received).
+Failures can be injected: failure_rate is the probability of answering a request with a 503,
+entry_failure_rate the probability that an entry fails processing.
+
+Run it standalone with
+    python nomad_stub_server.py --port 8000 --processing-delay 2
+and point the client to it with NOMAD_URL=http://127.0.0.1:8000/api/v1/
+or use it from python:
+    with NomadStubServer(processing_delay=0.5) as server:
+        api.upload_file(path, nomad_url=server.url)
+"""
+import io
+import json
+import time
+import uuid
+import base64
+import random
+import zipfile
+import argparse
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+API_PREFIX = '/api/v1/'
+COMPLETED_MESSAGE = 'Process process_upload completed successfully'
+
+
+def make_token(lifetime):
+    '''Unsigned JWT with an "exp" claim, enough for the client to know when to refresh it.'''
+    encode = lambda obj: base64.urlsafe_b64encode(json.dumps(obj).encode()).rstrip(b'=').decode()
+    return '.'.join([encode({'alg': 'none', 'typ': 'JWT'}),
+                     encode({'exp': int(time.time() + lifetime), 'jti': uuid.uuid4().hex}), ''])
+
+
+def list_mainfiles(file_name, body):
+    '''Mainfiles of an uploaded file: the *.archive.json members of a zip, or the file itself.'''
+    if file_name.endswith('.zip'):
+        try:
+            with zipfile.ZipFile(io.BytesIO(body)) as zf:
+                return [name for name in zf.namelist() if name.endswith('.archive.json')]
+        except zipfile.BadZipFile:
+            return []
+    return [file_name] if file_name.endswith('.archive.json') else []
+
+
+class StubUpload:
+    def __init__(self, upload_id, name=None):
+        self.upload_id = upload_id
+        self.name = name
+        self.mainfiles = []
+        self.size = 0
+        self.ready_at = time.time()
+        self.failed = set()
+
+    def add_file(self, file_name, body, server):
+        new = list_mainfiles(file_name, body)
+        self.mainfiles.extend(m for m in new if m not in self.mainfiles)
+        self.failed.update(m for m in new if random.random() < server.entry_failure_rate)
+        self.size += len(body)
+        # the upload is reprocessed after each file
+        self.ready_at = time.time() + server.processing_delay + server.processing_delay_per_mb * len(body) / 2**20
+
+
+class NomadStubServer:
+    """
+    Threaded stub of the NOMAD API on host:port (port 0 picks a free port).
+
+    Args:
+        processing_delay (float): Processing time of every upload (and of every PUT) [s].
+        processing_delay_per_mb (float): Additional processing time per MB received [s].
+        failure_rate (float): Probability of answering a request with 503 Service Unavailable.
+        entry_failure_rate (float): Probability that an entry fails processing.
+        response_delay (float): Latency added to every response [s].
+        token_lifetime (float): Lifetime of the access tokens [s]; expired tokens get a 401.
+        max_page_size (int): Max page size of the entries listing.
+    """
+    def __init__(self, host='127.0.0.1', port=0, processing_delay=1.0, processing_delay_per_mb=0.0,
+                 failure_rate=0.0, entry_failure_rate=0.0, response_delay=0.0, token_lifetime=3600,
+                 max_page_size=1000):
+        self.processing_delay = processing_delay
+        self.processing_delay_per_mb = processing_delay_per_mb
+        self.failure_rate = failure_rate
+        self.entry_failure_rate = entry_failure_rate
+        self.response_delay = response_delay
+        self.token_lifetime = token_lifetime
+        self.max_page_size = max_page_size
+        self.uploads = {}
+        self.tokens = {}
+        # requests served per endpoint (e.g. 'GET uploads/{id}'), injected failures under 'failures'
+        self.stats = Counter()
+        self.lock = threading.Lock()
+
+        server = self
+
+        class Handler(StubRequestHandler):
+            stub = server
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}{API_PREFIX}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, as the real server
+    stub = None
+
+    def log_message(self, *args):
+        pass
+
+    # ---------------    HELPERS    ---------------
+    def send_json(self, obj, status=200):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while (size := int(self.rfile.readline().split(b';')[0].strip(), 16)):
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            self.rfile.readline()
+            return b''.join(chunks)
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def authorized(self):
+        token = self.headers.get('Authorization', '')[len('Bearer '):]
+        with self.stub.lock:
+            expires_at = self.stub.tokens.get(token)
+        return expires_at is not None and time.time() < expires_at
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        path = url.path[len(API_PREFIX):] if url.path.startswith(API_PREFIX) else url.path.lstrip('/')
+        parts = [p for p in path.split('/') if p]
+        # the body has to be consumed even if the request fails, to keep the connection usable
+        body = self.read_body() if method in ('POST', 'PUT') else b''
+
+        endpoint = method + ' ' + '/'.join('{id}' if i == 1 and parts[0] == 'uploads' else p
+                                           for i, p in enumerate(parts))
+        with self.stub.lock:
+            self.stub.stats[endpoint] += 1
+        if self.stub.response_delay:
+            time.sleep(self.stub.response_delay)
+        if random.random() < self.stub.failure_rate:
+            with self.stub.lock:
+                self.stub.stats['failures'] += 1
+            return self.send_json({'detail': 'Injected failure'}, 503)
+
+        if parts == ['auth', 'token'] and method == 'GET':
+            return self.auth_token()
+        if not parts or parts[0] != 'uploads':
+            return self.send_json({'detail': 'Not Found'}, 404)
+        if not self.authorized():
+            return self.send_json({'detail': 'Invalid or expired token'}, 401)
+        if len(parts) == 1 and method == 'POST':
+            return self.create_upload(params, body)
+
+        with self.stub.lock:
+            upload = self.stub.uploads.get(parts[1])
+        if upload is None:
+            return self.send_json({'detail': f'Upload {parts[1]} not found'}, 404)
+        if len(parts) == 2 and method == 'GET':
+            return self.upload_status(upload)
+        if len(parts) == 2 and method == 'DELETE':
+            with self.stub.lock:
+                del self.stub.uploads[upload.upload_id]
+            return self.send_json({'upload_id': upload.upload_id, 'data': {'upload_id': upload.upload_id}})
+        if parts[2:] == ['entries'] and method == 'GET':
+            return self.upload_entries(upload, params)
+        if parts[2:3] == ['raw'] and method == 'PUT':
+            upload.add_file(params.get('file_name', 'file'), body, self.stub)
+            return self.send_json({'upload_id': upload.upload_id, 'data': {'upload_id': upload.upload_id}})
+        return self.send_json({'detail': 'Not Found'}, 404)
+
+    # ---------------    ENDPOINTS    ---------------
+    def auth_token(self):
+        token = make_token(self.stub.token_lifetime)
+        with self.stub.lock:
+            self.stub.tokens[token] = time.time() + self.stub.token_lifetime
+        self.send_json({'access_token': token, 'token_type': 'bearer'})
+
+    def create_upload(self, params, body):
+        upload = StubUpload(uuid.uuid4().hex[:22], params.get('upload_name'))
+        if body:
+            upload.add_file(params.get('file_name', 'file'), body, self.stub)
+        with self.stub.lock:
+            self.stub.uploads[upload.upload_id] = upload
+        self.send_json({'upload_id': upload.upload_id, 'data': {'upload_id': upload.upload_id}})
+
+    def upload_status(self, upload):
+        running = time.time() < upload.ready_at
+        self.send_json({'upload_id': upload.upload_id, 'data': {
+            'upload_id': upload.upload_id,
+            'upload_name': upload.name,
+            'process_running': running,
+            'last_status_message': 'Processing' if running else COMPLETED_MESSAGE,
+        }})
+
+    def upload_entries(self, upload, params):
+        page = max(int(params.get('page', 1)), 1)
+        page_size = min(max(int(params.get('page_size', 10)), 1), self.stub.max_page_size)
+        mainfiles = upload.mainfiles[(page - 1) * page_size:page * page_size]
+        self.send_json({
+            'upload_id': upload.upload_id,
+            'processing_successful': len(upload.mainfiles) - len(upload.failed),
+            'processing_failed': len(upload.failed),
+            'pagination': {'page': page, 'page_size': page_size, 'total': len(upload.mainfiles)},
+            'data': [{
+                'entry_id': uuid.uuid5(uuid.NAMESPACE_URL, upload.upload_id + '/' + mainfile).hex[:28],
+                'mainfile': mainfile,
+                'process_status': 'FAILURE' if mainfile in upload.failed else 'SUCCESS',
+            } for mainfile in mainfiles],
+        })
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in of the NOMAD API.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--processing-delay', type=float, default=1.0, help='processing time of each upload [s]')
+    parser.add_argument('--processing-delay-per-mb', type=float, default=0.0)
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='probability of a 503 response')
+    parser.add_argument('--entry-failure-rate', type=float, default=0.0, help='probability of a failed entry')
+    parser.add_argument('--response-delay', type=float, default=0.0, help='latency of every response [s]')
+    parser.add_argument('--token-lifetime', type=float, default=3600)
+    args = parser.parse_args()
+
+    server = NomadStubServer(args.host, args.port, args.processing_delay, args.processing_delay_per_mb,
+                             args.failure_rate, args.entry_failure_rate, args.response_delay, args.token_lifetime)
+    print(f'NOMAD stub listening on {server.url}')
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+        print(dict(server.stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Lightweight tracing of the FAIR export, to see where a slow export spends its time.
+
+    with tracing.trace('export', process=process_name, trace_file='static/FAIR/trace.jsonl'):
+        with tracing.span('db_fetch') as sp:
+            ...
+            sp['steps'] = steps.rec_count
+
+A span records its duration and the attributes set on it (sizes, counts). Spans opened inside
+another span are named after it (e.g. 'father/upload'). Every finished span is appended as a
+JSON line to the trace file, and the spans of a trace are aggregated per name in a summary
+that is written and printed when the trace ends. Traces and spans belong to the thread that
+opens them, so concurrent exports (see upload_outbox.py, bulk_upload_fair) do not mix.
+Without a trace file (argument or NOMAD_TRACE_FILE environment variable) spans are only summarized.
+"""
+import os
+import json
+import time
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+
+TRACE_FILE = os.environ.get('NOMAD_TRACE_FILE')
+
+_local = threading.local()
+_write_lock = threading.Lock()
+# keys of a trace that are not attributes
+_INTERNAL = ('trace_file', 'stack', 'spans')
+
+
+def emit(record, trace_file=None):
+    '''Append a record to the trace file as a JSON line.'''
+    trace_file = trace_file or TRACE_FILE
+    if not trace_file:
+        return
+    line = json.dumps(record, default=str) + '\n'
+    with _write_lock:
+        Path(trace_file).parent.mkdir(parents=True, exist_ok=True)
+        with open(trace_file, 'a', encoding='utf-8') as f:
+            f.write(line)
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+
+def format_summary(summary):
+    '''One line: total time, then time (and numeric attributes) of every span name.'''
+    parts = [f"{summary['trace']} {summary.get('process', '')}: {summary['duration']:.2f} s"]
+    for name, stats in summary['spans'].items():
+        extra = ', '.join(f'{k}={v}' for k, v in stats.items() if k not in ('count', 'time'))
+        count = f" x{stats['count']}" if stats['count'] > 1 else ''
+        parts.append(f"{name}{count} {stats['time']:.3f} s" + (f' ({extra})' if extra else ''))
+    return ' | '.join(parts)
+
+
+@contextmanager
+def trace(name, trace_file=None, **attrs):
+    '''
+    Collect the spans opened in this thread until the end of the block, then emit and print
+    their summary. attrs (e.g. process=...) are added to every span record and to the summary;
+    the block can add more to the yielded trace once they are known.
+    '''
+    parent = current_trace()
+    record = {'trace': name, **attrs, 'trace_file': trace_file, 'stack': [], 'spans': {}}
+    _local.trace = record
+    start = time.perf_counter()
+    error = None
+    try:
+        yield record
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        _local.trace = parent
+        duration = time.perf_counter() - start
+        summary = {'type': 'summary', **{k: v for k, v in record.items() if k not in _INTERNAL},
+                   'start': time.time() - duration, 'duration': duration, 'spans': record['spans']}
+        if error:
+            summary['error'] = error
+        emit(summary, trace_file)
+        print(format_summary(summary))
+
+
+@contextmanager
+def span(name, **attrs):
+    '''
+    Time the block. Yields a dict of attributes the block can fill (e.g. sizes, counts);
+    numeric attributes are summed in the summary of the trace.
+    '''
+    current = current_trace()
+    if current is not None and current['stack']:
+        name = current['stack'][-1] + '/' + name
+    if current is not None:
+        current['stack'].append(name)
+    start_time, start = time.time(), time.perf_counter()
+    try:
+        yield attrs
+    except BaseException as e:
+        attrs['error'] = repr(e)
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        record = {'type': 'span', 'span': name, 'start': start_time, 'duration': duration,
+                  'thread': threading.current_thread().name, **attrs}
+        if current is None:
+            emit(record)
+        else:
+            current['stack'].pop()
+            record.update((k, v) for k, v in current.items() if k not in _INTERNAL)
+            stats = current['spans'].setdefault(name, {'count': 0, 'time': 0.0})
+            stats['count'] += 1
+            stats['time'] += duration
+            for k, v in attrs.items():
+                if isinstance(v, (int, float)) and not isinstance(v, bool):
+                    stats[k] = stats.get(k, 0) + v
+            emit(record, current['trace_file'])
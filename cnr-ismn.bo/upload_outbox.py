@@ -0,0 +1,307 @@
+"""
+Persistent outbox of the NOMAD uploads: a small SQLite queue of jobs that a background
+worker drains with bounded concurrency, retries and status tracking, so the CAMS button
+only has to enqueue the job and the work survives network errors and server restarts.
+
+    outbox = Outbox('static/FAIR/outbox.sqlite')
+    job_id = outbox.enqueue('publish_fair', payload, key=process_name)
+
+    worker = OutboxWorker(outbox, {'publish_fair': publish_fair}, concurrency=2).start()
+    outbox.get(job_id)['status']   # pending -> running -> done / failed
+
+A handler receives the (JSON) payload and returns a JSON-serializable result; if it returns
+None or raises, the job is retried with exponential backoff up to max_attempts times. If it
+returns False (a failure that a retry cannot fix, e.g. entries that NOMAD failed to process),
+the job is marked as failed at once.
+
+The outbox can be drained by workers of several processes: a worker renews the heartbeat of
+the jobs it is running, and only the running jobs whose heartbeat is stale (their worker died,
+e.g. at a server restart) go back to pending.
+"""
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+import traceback
+from contextlib import contextmanager
+from pathlib import Path
+
+PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id           INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind         TEXT NOT NULL,
+    key          TEXT,
+    payload      TEXT NOT NULL,
+    status       TEXT NOT NULL DEFAULT 'pending',
+    attempts     INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    created      REAL NOT NULL,
+    updated      REAL NOT NULL,
+    last_error   TEXT,
+    result       TEXT,
+    owner        TEXT,
+    heartbeat    REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, next_attempt);
+"""
+# columns added after the first version of the table
+COLUMNS = {'owner': 'TEXT', 'heartbeat': 'REAL'}
+
+
+class Outbox:
+    """
+    SQLite job queue. Every call opens its own connection, so an Outbox can be shared
+    by the request handlers and the worker threads (and by different processes).
+
+    Args:
+        db_path (str or Path): SQLite file of the queue (created if missing).
+        max_attempts (int): Attempts of a job before it is marked as failed.
+        retry_delay (float): Delay before the first retry [s], doubled at every attempt.
+    """
+    def __init__(self, db_path, max_attempts=5, retry_delay=30):
+        self.db_path = Path(db_path)
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as con:
+            con.executescript(SCHEMA)
+            existing = {row['name'] for row in con.execute('PRAGMA table_info(jobs)')}
+            for name, sql_type in COLUMNS.items():
+                if name not in existing:
+                    con.execute(f'ALTER TABLE jobs ADD COLUMN {name} {sql_type}')
+
+    @contextmanager
+    def _connect(self):
+        con = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)  # autocommit
+        con.row_factory = sqlite3.Row
+        try:
+            con.execute('PRAGMA journal_mode=WAL')
+            yield con
+        finally:
+            con.close()
+
+    def enqueue(self, kind, payload, key=None):
+        '''Add a job and return its id. If a pending or running job with the same key
+        already exists (e.g. the same process queued twice), its id is returned instead.'''
+        now = time.time()
+        with self._connect() as con:
+            con.execute('BEGIN IMMEDIATE')
+            if key is not None:
+                row = con.execute('SELECT id FROM jobs WHERE kind = ? AND key = ? AND status IN (?, ?)',
+                                  (kind, key, PENDING, RUNNING)).fetchone()
+                if row:
+                    con.execute('COMMIT')
+                    return row['id']
+            job_id = con.execute(
+                'INSERT INTO jobs (kind, key, payload, next_attempt, created, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                (kind, key, json.dumps(payload), now, now, now)).lastrowid
+            con.execute('COMMIT')
+            return job_id
+
+    def claim(self, kinds=None, owner=None):
+        '''Atomically take the oldest due pending job (of the given kinds) and mark it as running
+        by owner, with a fresh heartbeat. Returns the job as a dict (payload decoded), None if
+        there is nothing to do.'''
+        with self._connect() as con:
+            con.execute('BEGIN IMMEDIATE')
+            query = 'SELECT * FROM jobs WHERE status = ? AND next_attempt <= ?'
+            args = [PENDING, time.time()]
+            if kinds:
+                query += ' AND kind IN ({})'.format(', '.join('?' * len(kinds)))
+                args += list(kinds)
+            row = con.execute(query + ' ORDER BY next_attempt, id LIMIT 1', args).fetchone()
+            if row is None:
+                con.execute('COMMIT')
+                return None
+            con.execute('UPDATE jobs SET status = ?, attempts = attempts + 1, updated = ?, owner = ?, heartbeat = ? '
+                        'WHERE id = ?', (RUNNING, time.time(), owner, time.time(), row['id']))
+            con.execute('COMMIT')
+        job = dict(row)
+        job['attempts'] += 1
+        job['payload'] = json.loads(job['payload'])
+        return job
+
+    def complete(self, job_id, result=None):
+        with self._connect() as con:
+            con.execute('UPDATE jobs SET status = ?, result = ?, last_error = NULL, updated = ? WHERE id = ?',
+                        (DONE, json.dumps(result), time.time(), job_id))
+
+    def fail(self, job_id, error, final=False):
+        '''Record a failed attempt: the job goes back to pending with backoff, or to failed
+        once max_attempts have been made (at once if final).'''
+        with self._connect() as con:
+            attempts = con.execute('SELECT attempts FROM jobs WHERE id = ?', (job_id,)).fetchone()['attempts']
+            if final or attempts >= self.max_attempts:
+                con.execute('UPDATE jobs SET status = ?, last_error = ?, updated = ? WHERE id = ?',
+                            (FAILED, error, time.time(), job_id))
+            else:
+                con.execute('UPDATE jobs SET status = ?, last_error = ?, next_attempt = ?, updated = ? WHERE id = ?',
+                            (PENDING, error, time.time() + self.retry_delay * 2 ** (attempts - 1), time.time(), job_id))
+
+    def retry(self, job_id):
+        '''Put a failed job back in the queue, with a new budget of attempts.'''
+        with self._connect() as con:
+            con.execute('UPDATE jobs SET status = ?, attempts = 0, next_attempt = ?, updated = ? WHERE id = ?',
+                        (PENDING, time.time(), time.time(), job_id))
+
+    def heartbeat(self, job_ids):
+        '''Mark the running jobs job_ids as still alive.'''
+        if not job_ids:
+            return
+        with self._connect() as con:
+            con.execute('UPDATE jobs SET heartbeat = ? WHERE status = ? AND id IN ({})'.format(', '.join('?' * len(job_ids))),
+                        [time.time(), RUNNING] + list(job_ids))
+
+    def requeue_stale(self, stale_after):
+        '''Jobs left running by a worker that died (no heartbeat for stale_after seconds,
+        e.g. server restart) go back to pending.'''
+        now = time.time()
+        with self._connect() as con:
+            return con.execute('UPDATE jobs SET status = ?, next_attempt = ?, updated = ? '
+                               'WHERE status = ? AND (heartbeat IS NULL OR heartbeat < ?)',
+                               (PENDING, now, now, RUNNING, now - stale_after)).rowcount
+
+    def get(self, job_id):
+        with self._connect() as con:
+            row = con.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
+        job['result'] = json.loads(job['result']) if job['result'] is not None else None
+        return job
+
+    def jobs(self, status=None, kind=None):
+        '''List the jobs (without payload), optionally filtered by status and kind.'''
+        query, args = 'SELECT id, kind, key, status, attempts, created, updated, last_error FROM jobs WHERE 1', []
+        if status:
+            query += ' AND status = ?'
+            args.append(status)
+        if kind:
+            query += ' AND kind = ?'
+            args.append(kind)
+        with self._connect() as con:
+            return [dict(row) for row in con.execute(query + ' ORDER BY id', args)]
+
+    def counts(self):
+        with self._connect() as con:
+            return {row['status']: row['n'] for row in con.execute('SELECT status, COUNT(*) AS n FROM jobs GROUP BY status')}
+
+
+class OutboxWorker:
+    """
+    Background threads that drain an Outbox, running at most `concurrency` jobs at a time.
+
+    Args:
+        outbox (Outbox): The queue to drain.
+        handlers (dict): kind -> function(payload) returning the result (None means failure,
+            False a failure that is not retried).
+        concurrency (int): Number of worker threads.
+        poll_interval (float): Max time between two checks of the queue when idle [s];
+            enqueue through the worker (or call wake) to start a job immediately.
+        heartbeat_interval (float): Time between two heartbeats of the running jobs [s].
+        stale_after (float): Running jobs without a heartbeat for this long [s] are requeued
+            (checked at every heartbeat), also those of the workers of other processes.
+    """
+    def __init__(self, outbox, handlers, concurrency=2, poll_interval=5, heartbeat_interval=30, stale_after=120):
+        self.outbox = outbox
+        self.handlers = handlers
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_after = stale_after
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{id(self):x}'
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self._running = set()
+        self._running_lock = threading.Lock()
+
+    def start(self):
+        if self._threads:
+            return self
+        self.outbox.requeue_stale(self.stale_after)
+        self._stop.clear()
+        self._threads = [threading.Thread(target=self._run, name=f'outbox-worker-{n}', daemon=True)
+                         for n in range(self.concurrency)]
+        self._threads.append(threading.Thread(target=self._beat, name='outbox-heartbeat', daemon=True))
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self, wait=True):
+        self._stop.set()
+        self._wake.set()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+    def wake(self):
+        self._wake.set()
+
+    def enqueue(self, kind, payload, key=None):
+        job_id = self.outbox.enqueue(kind, payload, key)
+        self.wake()
+        return job_id
+
+    def _run(self):
+        while not self._stop.is_set():
+            job = self.outbox.claim(list(self.handlers), self.owner)
+            if job is None:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+            with self._running_lock:
+                self._running.add(job['id'])
+            try:
+                self.run_job(job)
+            finally:
+                with self._running_lock:
+                    self._running.discard(job['id'])
+
+    def _beat(self):
+        '''Renew the heartbeat of the running jobs, and requeue the stale ones of dead workers.'''
+        while not self._stop.wait(self.heartbeat_interval):
+            try:
+                with self._running_lock:
+                    running = list(self._running)
+                self.outbox.heartbeat(running)
+                if self.outbox.requeue_stale(self.stale_after):
+                    self.wake()
+            except sqlite3.Error as e:
+                print(f"Outbox heartbeat failed: {e}")
+
+    def run_job(self, job):
+        try:
+            result = self.handlers[job['kind']](job['payload'])
+        except Exception:
+            print(f"Job {job['id']} ({job['kind']} {job['key']}) raised an exception:")
+            traceback.print_exc()
+            self.outbox.fail(job['id'], traceback.format_exc(limit=5))
+            return
+        if result is None:
+            print(f"Job {job['id']} ({job['kind']} {job['key']}) failed, attempt {job['attempts']}.")
+            self.outbox.fail(job['id'], 'handler returned None')
+        elif result is False:
+            print(f"Job {job['id']} ({job['kind']} {job['key']}) failed, not retried.")
+            self.outbox.fail(job['id'], 'handler returned False', final=True)
+        else:
+            self.outbox.complete(job['id'], result)
+
+
+_workers = {}
+_workers_lock = threading.Lock()
+
+def get_worker(db_path, handlers, concurrency=2):
+    """Return the running OutboxWorker of db_path in this process (started on first use)."""
+    with _workers_lock:
+        key = str(Path(db_path).resolve())
+        worker = _workers.get(key)
+        if worker is None:
+            worker = _workers[key] = OutboxWorker(Outbox(db_path), handlers, concurrency).start()
+        return worker